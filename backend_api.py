@@ -1,22 +1,49 @@
 """
 FastAPI Backend cho Task Management AI - OpenAI Version (Dynamic Labels + Project Creation)
-Cài đặt: pip install fastapi uvicorn openai python-dotenv pydantic
+Cài đặt: pip install fastapi uvicorn openai python-dotenv pydantic tiktoken
+Tùy chọn: pip install msgpack (hỗ trợ Content-Type / Accept: application/msgpack)
 Chạy: python backend_api.py
+Backfill: python backend_api.py backfill --input notes.jsonl --output tasks.jsonl
+Probes: GET /live (liveness), GET /ready (readiness - 503 cho đến khi warm-up xong)
 """
 
-from fastapi import FastAPI, HTTPException, Depends, Header
+import time
+_IMPORT_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from pydantic import BaseModel, Field, validator
 from typing import List, Optional, Dict, Any
-import uvicorn
 from datetime import datetime
-import time
 import os
-from openai import OpenAI
 import json
 import uuid
+import argparse
+import asyncio
+import hashlib
+import math
+import multiprocessing
+import queue
+import random
+import re
+import sys
+import threading
+import unicodedata
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
 from dotenv import load_dotenv
 
+try:
+    import msgpack
+except ImportError:  # msgpack là tùy chọn: không cài thì chỉ phục vụ JSON
+    msgpack = None
+
 load_dotenv()
 
 # ==================== CONFIGURATION ====================
@@ -25,8 +52,102 @@ class Config:
     MODEL = "gpt-4o-mini"
     TEMPERATURE = 0
     MAX_RETRIES = 3
-    TIMEOUT = 30
+    TIMEOUT = 30                    # timeout tối đa cho 1 lần gọi upstream (giây)
+    MIN_TIMEOUT = 5
+    ADAPTIVE_TIMEOUT_PERCENTILE = 0.99
+    ADAPTIVE_TIMEOUT_MULTIPLIER = 2.0
+    LATENCY_WINDOW = 200
+    MIN_ATTEMPT_SECONDS = 1.0       # không bắt đầu attempt nếu deadline còn ít hơn
+    DISCONNECT_POLL_SECONDS = 0.5
     MAX_BATCH_SIZE = 50
+    FOLDER_MATCH_THRESHOLD = 0.6
+    
+    # Batch folder suggestion: điểm lexical đủ chắc chắn thì không cần gọi LLM
+    MAX_BATCH_FOLDER_NOTES = 500
+    FOLDER_LOCAL_MATCH_SCORE = 0.8
+    FOLDER_LOCAL_MARGIN = 0.3
+    FOLDER_BATCH_PACK_SIZE = 20     # số note ambiguous gộp vào 1 prompt
+    FOLDER_BATCH_CONCURRENCY = 5    # số pack gửi LLM song song tối đa / request
+    
+    # Taxonomy (areas + folders) của user, cache in-memory cho analyze-and-place
+    TAXONOMY_CACHE_SIZE = 1000
+    TAXONOMY_TTL_SECONDS = 3600
+    PLACEMENT_MATCH_SCORE = 0.5
+    
+    # Idempotency-Key cho các endpoint gọi AI
+    IDEMPOTENCY_TTL_SECONDS = 600
+    IDEMPOTENCY_MAX_KEYS = 10000
+    
+    # Nén input trước khi gửi LLM: các rule chạy theo thứ tự (override bằng env COMPACTION_RULES="a,b,c")
+    COMPACTION_RULES = [
+        rule.strip() for rule in
+        os.getenv("COMPACTION_RULES", "markdown_images,urls,quoted_thread,signature,whitespace").split(",")
+        if rule.strip()
+    ]
+    COMPACTION_URL_MAX_CHARS = 30      # URL dài hơn -> [link: domain]
+    INPUT_TOKEN_BUDGETS = {            # token tối đa của text note / mô tả / chunk
+        "analyze": 3000,
+        "create_project": 2000,
+        "suggest_folder": 1000
+    }
+    OVERSIZE_STRATEGY = {              # vượt budget: "chunk" (gọi nhiều lần rồi gộp) | "truncate"
+        "analyze": "chunk",
+        "create_project": "truncate",
+        "suggest_folder": "truncate"
+    }
+    MAX_INPUT_CHUNKS = 4               # chunk sau chunk thứ N bị bỏ
+    
+    # Semantic cache cho /api/analyze: note gần giống nhau (MinHash/LSH) dùng lại tasks
+    SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+    # false (mặc định): cache tách riêng theo user_id, request không có user_id không dùng cache.
+    # true: mọi user dùng chung 1 cache (chỉ bật khi notes không chứa dữ liệu riêng tư)
+    SEMANTIC_CACHE_SHARED = os.getenv("SEMANTIC_CACHE_SHARED", "false").lower() == "true"
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.96"))  # Jaccard ước lượng
+    SEMANTIC_CACHE_MAX_ENTRIES = 5000
+    SEMANTIC_CACHE_TTL_SECONDS = 86400
+    SEMANTIC_CACHE_SHINGLE_SIZE = 5        # shingle ký tự trên text đã chuẩn hóa
+    SEMANTIC_CACHE_PERMUTATIONS = 64
+    SEMANTIC_CACHE_BANDS = 16              # 16 bands x 4 rows
+    SEMANTIC_CACHE_AUDIT_RATE = float(os.getenv("SEMANTIC_CACHE_AUDIT_RATE", "0.02"))
+    SEMANTIC_CACHE_AUDIT_AGREEMENT = 0.5   # dưới ngưỡng này -> false hit
+    
+    # Điểm (note, folder) đã chấm: đổi danh sách folder chỉ phải chấm phần thay đổi
+    FOLDER_SCORE_CACHE_SIZE = 10000    # số notes tối đa
+    FOLDER_SCORE_TTL_SECONDS = 86400
+    
+    # Khởi động: warm-up chạy nền sau khi server đã nhận kết nối, /ready trả 503 cho đến khi xong
+    WARMUP_UPSTREAM = os.getenv("WARMUP_UPSTREAM", "true").lower() == "true"
+    WARMUP_TIMEOUT_SECONDS = 5
+    SERVER_RELOAD = os.getenv("SERVER_RELOAD", "true").lower() == "true"
+    
+    # Backfill CLI
+    BACKFILL_CHECKPOINT_SECONDS = 30
+    BACKFILL_REPORT_SECONDS = 10
+    BACKFILL_POLL_SECONDS = 5          # chu kỳ kiểm tra worker còn sống khi chờ kết quả
+    
+    # Batch project creation
+    MAX_BATCH_PROJECTS = 20
+    PROJECT_CONCURRENCY = 5         # số project tạo song song tối đa / request
+    
+    # Model routing: danh sách tier từ nhanh/rẻ -> mạnh (override bằng env MODEL_TIERS dạng JSON)
+    MODEL_TIERS = json.loads(os.getenv("MODEL_TIERS") or "null") or [
+        {"name": "fast", "model": MODEL},
+        {"name": "strong", "model": "gpt-4o"}
+    ]
+    ENDPOINT_TIERS = {
+        "suggest_folder": "fast",
+        "analyze": "fast",
+        "create_project": "strong"
+    }
+    ROUTING_LONG_INPUT_TOKENS = 1500   # input dài hơn -> tier mạnh hơn
+    ROUTING_WINDOW = 50                # số request gần nhất để tính latency/error rate
+    ROUTING_MIN_SAMPLES = 5
+    ROUTING_MAX_ERROR_RATE = 0.3
+    
+    # Cassette: ghi lại / phát lại traffic upstream (record | replay | rỗng = tắt)
+    CASSETTE_MODE = os.getenv("CASSETTE_MODE", "").lower()
+    CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes/llm_traffic.jsonl")
+    CASSETTE_REPLAY_LATENCY = os.getenv("CASSETTE_REPLAY_LATENCY", "false").lower() == "true"
     
     EXAMPLE_PROJECTS = [
         "Dự án Web",
@@ -124,6 +245,29 @@ class ProjectCreationResponse(BaseModel):
     processing_time_ms: float
 
 
+class BatchProjectCreationRequest(BaseModel):
+    """Request tạo nhiều projects cùng lúc"""
+    projects: List[ProjectCreationRequest] = Field(..., min_items=1)
+    stream: bool = Field(False, description="True: trả NDJSON, mỗi dòng 1 project ngay khi xong")
+
+
+class BatchProjectItemResult(BaseModel):
+    """Kết quả của 1 project trong batch"""
+    index: int
+    success: bool
+    result: Optional[ProjectCreationResponse] = None
+    error: Optional[str] = None
+
+
+class BatchProjectCreationResponse(BaseModel):
+    """Response batch project creation (giữ thứ tự request)"""
+    total: int
+    successful: int
+    failed: int
+    results: List[BatchProjectItemResult]
+    processing_time_ms: float
+
+
 class TaskResponse(BaseModel):
     """Response cho 1 task"""
     task_id: str
@@ -184,23 +328,149 @@ class FolderSuggestionResponse(BaseModel):
     reasoning: str
     all_scores: List[Dict[str, Any]]
     metadata: Dict[str, Any]
-    processing_time_ms: float    
+    processing_time_ms: float
 
 
-# ==================== OPENAI SERVICE ====================
-class OpenAITaskAnalyzer:
-    """Service xử lý AI với OpenAI"""
-    
-    def __init__(self, api_key: str):
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY is required")
-        self.client = OpenAI(api_key=api_key)
-        self.model = Config.MODEL
-        self.temperature = Config.TEMPERATURE
-    
-    def _construct_system_prompt(self) -> str:
-        """Tạo system prompt cho OpenAI - không giới hạn danh sách"""
-        return f"""Bạn là một AI chuyên gia phân tích ghi chú tiếng Việt và trích xuất danh sách công việc cụ thể.
+class BatchFolderNote(BaseModel):
+    """1 note trong batch folder suggestion"""
+    text: str = Field(..., min_length=10, description="Nội dung note cần phân loại")
+    note_id: Optional[str] = None
+
+
+class BatchFolderSuggestionRequest(BaseModel):
+    """Request gợi ý folder cho nhiều notes với cùng 1 danh sách folders"""
+    notes: List[BatchFolderNote] = Field(..., min_items=1)
+    user_folders: List[Dict[str, str]] = Field(..., description="Danh sách folders hiện có của user")
+    user_id: Optional[str] = None
+
+
+class BatchFolderSuggestionResponse(BaseModel):
+    """Response cho batch folder suggestion (mỗi note 1 FolderSuggestionResponse)"""
+    success: bool
+    results: List[FolderSuggestionResponse]
+    metadata: Dict[str, Any]
+    processing_time_ms: float
+
+
+class Taxonomy(BaseModel):
+    """Areas + folders hiện có của user"""
+    areas: List[Dict[str, str]] = Field(..., description="[{_id, name}]")
+    folders: List[Dict[str, str]] = Field(..., description="[{_id, name, areaId}]")
+    version: Optional[str] = Field(None, description="Version phía caller (vd max updatedAt); bỏ trống thì tự hash")
+
+
+class TaxonomyRegistrationRequest(Taxonomy):
+    """Đăng ký / cập nhật taxonomy của user"""
+    user_id: str
+
+
+class AnalyzeAndPlaceRequest(BaseModel):
+    """Request phân tích note và xếp vào area/folder của user trong 1 lần gọi"""
+    text: str = Field(..., min_length=10, description="Nội dung ghi chú cần phân tích")
+    user_id: str
+    taxonomy: Optional[Taxonomy] = Field(None, description="Bỏ trống để dùng taxonomy đã đăng ký")
+    taxonomy_version: Optional[str] = Field(None, description="Version taxonomy hiện tại phía caller; lệch thì trả 409")
+
+
+class PlacementTarget(BaseModel):
+    """Area / folder được chọn: id có sẵn hoặc is_new = true (cần tạo mới)"""
+    id: Optional[str] = None
+    name: str
+    is_new: bool
+    score: float
+
+
+class PlacedTaskResponse(TaskResponse):
+    """Task kèm area / folder đã resolve"""
+    area: PlacementTarget
+    folder: PlacementTarget
+
+
+class AnalyzeAndPlaceResponse(BaseModel):
+    """Response analyze-and-place: tasks + vị trí cho cả note"""
+    success: bool
+    tasks: List[PlacedTaskResponse]
+    area: PlacementTarget
+    folder: PlacementTarget
+    metadata: Dict[str, Any]
+    processing_time_ms: float
+
+
+# ==================== COMPACT WIRE SCHEMA ====================
+# Model trả về JSON dạng gọn (khóa ngắn + enum code), server mở rộng lại
+# về TaskResponse / ProjectCreationResponse / FolderSuggestionResponse.
+PRIORITY_CODES = {"L": "Low", "M": "Medium", "H": "High"}
+STATUS_CODES = {"t": "todo", "g": "doing", "d": "done", "p": "pending"}
+ENERGY_CODES = {"l": "low", "m": "medium", "h": "high", "u": "urgent"}
+
+
+def _strict_object(properties: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON schema object cho strict structured outputs (mọi field đều required)"""
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties.keys()),
+        "additionalProperties": False
+    }
+
+
+def _json_schema_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+_STR = {"type": "string"}
+_INT = {"type": "integer"}
+_NUM = {"type": "number"}
+
+ANALYSIS_RESPONSE_FORMAT = _json_schema_format("task_extraction", _strict_object({
+    "t": {"type": "array", "items": _strict_object({
+        "x": _STR,
+        "m": _INT,
+        "p": {"type": "string", "enum": list(PRIORITY_CODES)},
+        "j": _STR,
+        "c": _STR
+    })}
+}))
+
+PROJECT_RESPONSE_FORMAT = _json_schema_format("project_creation", _strict_object({
+    "p": _strict_object({
+        "n": _STR,
+        "d": _STR,
+        "dd": _INT,
+        "p": {"type": "string", "enum": list(PRIORITY_CODES)},
+        "a": _STR,
+        "co": _INT,
+        "ic": _INT,
+        "e": {"type": "string", "enum": list(ENERGY_CODES)}
+    }),
+    "t": {"type": "array", "items": _strict_object({
+        "x": _STR,
+        "m": _INT,
+        "p": {"type": "string", "enum": list(PRIORITY_CODES)},
+        "s": {"type": "string", "enum": list(STATUS_CODES)},
+        "e": {"type": "string", "enum": list(ENERGY_CODES)},
+        "c": _STR,
+        "o": _INT
+    })}
+}))
+
+_FOLDER_RESULT_SCHEMA = {
+    "i": _INT,
+    "c": _NUM,
+    "r": _STR,
+    "s": {"type": "array", "items": _NUM}
+}
+
+FOLDER_RESPONSE_FORMAT = _json_schema_format("folder_suggestion", _strict_object(_FOLDER_RESULT_SCHEMA))
+
+FOLDER_BATCH_RESPONSE_FORMAT = _json_schema_format("batch_folder_suggestion", _strict_object({
+    "r": {"type": "array", "items": _strict_object({"n": _INT, **_FOLDER_RESULT_SCHEMA})}
+}))
+
+
+# ==================== PROMPTS ====================
+# System prompts tĩnh được dựng 1 lần lúc import, không dựng lại cho mỗi request
+ANALYSIS_SYSTEM_PROMPT = """Bạn là một AI chuyên gia phân tích ghi chú tiếng Việt và trích xuất danh sách công việc cụ thể.
 
 QUY TẮC NGHIÊM NGẶT BẮT BUỘC:
 1. Mỗi task PHẢI là một câu tiếng Việt hoàn chỉnh, rõ ràng, có nghĩa
@@ -242,9 +512,7 @@ QUAN TRỌNG:
 - Tên dự án và chủ đề phải có ý nghĩa, dễ hiểu, phù hợp với ngữ cảnh Việt Nam
 - Hãy sáng tạo nhưng hợp lý - đặt tên sao cho người dùng dễ quản lý và tìm kiếm sau này"""
 
-    def _construct_project_system_prompt(self) -> str:
-        """System prompt cho việc tạo project"""
-        return """Bạn là AI chuyên gia lập kế hoạch dự án, phân tích yêu cầu và tạo danh sách công việc chi tiết.
+PROJECT_SYSTEM_PROMPT = """Bạn là AI chuyên gia lập kế hoạch dự án, phân tích yêu cầu và tạo danh sách công việc chi tiết.
 
 NHIỆM VỤ:
 1. Phân tích mô tả dự án và tạo thông tin project hoàn chỉnh
@@ -276,6 +544,1064 @@ QUAN TRỌNG:
 - Tasks phải bao phủ toàn bộ quy trình từ đầu đến cuối
 - Chỉ xuất JSON hợp lệ, KHÔNG có markdown"""
 
+
+# ==================== CASSETTE (RECORD / REPLAY) ====================
+class LLMCassette:
+    """
+    Ghi lại / phát lại các cặp request-response upstream vào file JSONL.
+    - record: append mỗi lần gọi OpenAI (prompt hash, messages, completion, usage, latency)
+    - replay: trả completion từ cassette theo prompt hash, không gọi OpenAI
+    """
+
+    def __init__(self, path: str, mode: str, replay_latency: bool = False):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Invalid cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self._lock = threading.Lock()
+        self._entries: Dict[str, deque] = defaultdict(deque)
+
+        if mode == "replay":
+            self._load()
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def prompt_hash(model: str, temperature: float, messages: List[Dict[str, str]]) -> str:
+        """Hash ổn định của prompt (model + temperature + messages)"""
+        payload = json.dumps(
+            {"model": model, "temperature": temperature, "messages": messages},
+            ensure_ascii=False,
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            raise ValueError(f"Cassette file not found: {self.path}")
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                entry = json.loads(line)
+                self._entries[entry["prompt_hash"]].append(entry)
+
+    def record(self, endpoint: str, prompt_hash: str, model: str, messages: List[Dict[str, str]],
+               completion: str, usage: Dict[str, int], latency_ms: float):
+        entry = {
+            "prompt_hash": prompt_hash,
+            "endpoint": endpoint,
+            "model": model,
+            "messages": messages,
+            "completion": completion,
+            "usage": usage,
+            "latency_ms": round(latency_ms, 2),
+            "recorded_at": datetime.utcnow().isoformat()
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def replay(self, prompt_hash: str) -> dict:
+        """
+        Lấy entry đã ghi cho prompt hash. Nhiều entry cùng hash được phát lại
+        lần lượt (xoay vòng) để giữ nguyên phân bố của traffic thật.
+        """
+        with self._lock:
+            entries = self._entries.get(prompt_hash)
+            if not entries:
+                raise ValueError(f"Cassette miss for prompt hash {prompt_hash[:12]}")
+            entry = entries.popleft()
+            entries.append(entry)
+
+        if self.replay_latency:
+            time.sleep(entry.get("latency_ms", 0) / 1000)
+        return entry
+
+
+def load_cassette() -> Optional[LLMCassette]:
+    """Tạo cassette từ Config (None nếu tắt)"""
+    if not Config.CASSETTE_MODE:
+        return None
+    return LLMCassette(
+        path=Config.CASSETTE_PATH,
+        mode=Config.CASSETTE_MODE,
+        replay_latency=Config.CASSETTE_REPLAY_LATENCY
+    )
+
+
+# ==================== DEADLINES & TIMEOUTS ====================
+class DeadlineExceeded(Exception):
+    """Không còn đủ thời gian trong deadline của request"""
+
+
+class RequestCancelled(DeadlineExceeded):
+    """Client đã ngắt kết nối, không cần làm tiếp"""
+
+
+class Deadline:
+    """
+    Deadline end-to-end của 1 request (X-Request-Deadline-Ms = số ms còn lại phía caller).
+    Được truyền xuống từng attempt upstream và từng lần backoff.
+    """
+
+    def __init__(self, budget_seconds: Optional[float] = None):
+        self.expires_at = time.monotonic() + budget_seconds if budget_seconds is not None else None
+        self._cancelled = threading.Event()
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return math.inf
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def check(self, minimum: float = 0.0):
+        if self.cancelled:
+            raise RequestCancelled("Client disconnected")
+        if self.remaining() < max(minimum, 1e-3):
+            raise DeadlineExceeded("Request deadline exceeded")
+
+    def sleep(self, seconds: float):
+        """Sleep nhưng thức dậy ngay khi request bị hủy"""
+        if self._cancelled.wait(seconds):
+            raise RequestCancelled("Client disconnected")
+
+
+class LatencyTracker:
+    """Latency upstream gần đây theo endpoint -> timeout thích ứng theo percentile"""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples: Dict[str, deque] = defaultdict(lambda: deque(maxlen=self.window))
+
+    def observe(self, endpoint: str, latency_seconds: float):
+        with self._lock:
+            self._samples[endpoint].append(latency_seconds)
+
+    def percentile(self, endpoint: str, pct: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(pct * len(samples)))]
+
+    def timeout_for(self, endpoint: str) -> float:
+        """p99 x hệ số, kẹp trong [MIN_TIMEOUT, TIMEOUT]; chưa đủ dữ liệu thì dùng TIMEOUT"""
+        with self._lock:
+            enough = len(self._samples.get(endpoint, ())) >= Config.ROUTING_MIN_SAMPLES
+        if not enough:
+            return Config.TIMEOUT
+        p = self.percentile(endpoint, Config.ADAPTIVE_TIMEOUT_PERCENTILE)
+        return min(Config.TIMEOUT, max(Config.MIN_TIMEOUT, p * Config.ADAPTIVE_TIMEOUT_MULTIPLIER))
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = list(self._samples.keys())
+        return {
+            endpoint: {
+                "p50_seconds": self.percentile(endpoint, 0.5),
+                "p99_seconds": self.percentile(endpoint, 0.99),
+                "timeout_seconds": self.timeout_for(endpoint)
+            }
+            for endpoint in endpoints
+        }
+
+
+# ==================== MODEL ROUTER ====================
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token (~4 ký tự / token)"""
+    return max(1, len(text) // 4)
+
+
+class ModelRouter:
+    """
+    Chọn model cho từng request theo:
+    - endpoint (tier mặc định trong Config.ENDPOINT_TIERS)
+    - độ dài input (token)
+    - latency / error rate gần đây của từng model
+    - latency budget của caller
+    Thứ tự model trả về là thứ tự fallback khi retry.
+    """
+
+    def __init__(self, tiers: List[Dict[str, str]]):
+        if not tiers:
+            raise ValueError("At least one model tier is required")
+        self.tiers = tiers
+        self._lock = threading.Lock()
+        self._observations: Dict[str, deque] = {
+            tier["model"]: deque(maxlen=Config.ROUTING_WINDOW) for tier in tiers
+        }
+
+    def _tier_index(self, name: str) -> int:
+        for idx, tier in enumerate(self.tiers):
+            if tier["name"] == name:
+                return idx
+        return 0
+
+    def observe(self, model: str, latency_ms: float, ok: bool):
+        with self._lock:
+            self._observations.setdefault(model, deque(maxlen=Config.ROUTING_WINDOW)).append((latency_ms, ok))
+
+    def stats(self, model: str) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._observations.get(model, ()))
+        latencies = sorted(latency for latency, ok in samples if ok)
+        errors = sum(1 for _, ok in samples if not ok)
+        return {
+            "samples": len(samples),
+            "p50_latency_ms": round(latencies[len(latencies) // 2], 2) if latencies else None,
+            "error_rate": round(errors / len(samples), 3) if samples else 0.0
+        }
+
+    def route(self, endpoint: str, input_tokens: int, latency_budget_ms: Optional[float] = None) -> Dict[str, Any]:
+        """Trả về quyết định routing: tier, model, lý do, thứ tự fallback"""
+        idx = self._tier_index(Config.ENDPOINT_TIERS.get(endpoint, self.tiers[0]["name"]))
+        reason = "endpoint"
+        
+        if input_tokens >= Config.ROUTING_LONG_INPUT_TOKENS and idx < len(self.tiers) - 1:
+            idx = len(self.tiers) - 1
+            reason = "long_input"
+        
+        # Sắp xếp các tier còn lại theo khoảng cách tới tier ưu tiên
+        order = sorted(range(len(self.tiers)), key=lambda i: (abs(i - idx), i))
+        stats = {i: self.stats(self.tiers[i]["model"]) for i in order}
+        
+        def healthy(i: int) -> bool:
+            st = stats[i]
+            return st["samples"] < Config.ROUTING_MIN_SAMPLES or st["error_rate"] <= Config.ROUTING_MAX_ERROR_RATE
+        
+        def within_budget(i: int) -> bool:
+            p50 = stats[i]["p50_latency_ms"]
+            return latency_budget_ms is None or p50 is None or p50 <= latency_budget_ms
+        
+        if not healthy(order[0]):
+            alternative = next((i for i in order[1:] if healthy(i)), None)
+            if alternative is not None:
+                order.remove(alternative)
+                order.insert(0, alternative)
+                reason = "error_rate"
+        
+        if not within_budget(order[0]):
+            alternative = next((i for i in order[1:] if healthy(i) and within_budget(i)), None)
+            if alternative is not None:
+                order.remove(alternative)
+                order.insert(0, alternative)
+                reason = "latency_budget"
+        
+        chosen = self.tiers[order[0]]
+        return {
+            "tier": chosen["name"],
+            "model": chosen["model"],
+            "reason": reason,
+            "input_tokens": input_tokens,
+            "latency_budget_ms": latency_budget_ms,
+            "fallback_models": [self.tiers[i]["model"] for i in order[1:]]
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {tier["name"]: {"model": tier["model"], **self.stats(tier["model"])} for tier in self.tiers}
+
+
+# ==================== INPUT COMPACTION ====================
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def _get_tokenizer():
+    """Tokenizer local của model (tiktoken), load 1 lần; không có thì None"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    import tiktoken
+                    _tokenizer = tiktoken.encoding_for_model(Config.MODEL)
+                except Exception:
+                    _tokenizer = False
+    return _tokenizer or None
+
+
+def count_tokens(text: str) -> int:
+    """Đếm token bằng tokenizer của model, fallback sang estimate_tokens"""
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer.encode(text))
+
+
+def token_counter_name() -> str:
+    """Tên bộ đếm token đang dùng: "tiktoken" hoặc "estimate" (len/4 khi thiếu tiktoken)"""
+    return "tiktoken" if _get_tokenizer() is not None else "estimate"
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return text[:max_tokens * 4]
+    token_ids = tokenizer.encode(text)
+    if len(token_ids) <= max_tokens:
+        return text
+    return tokenizer.decode(token_ids[:max_tokens])
+
+
+MARKDOWN_IMAGE_PATTERN = re.compile(r"!\[([^\]]*)\]\([^)]*\)")
+MARKDOWN_LINK_PATTERN = re.compile(r"\[([^\]]+)\]\((https?://[^)\s]+)\)")
+URL_PATTERN = re.compile(r"(?:https?://|www\.)[^\s<>()\[\]]+")
+QUOTED_THREAD_PATTERN = re.compile(
+    r"^\s*(?:On\s.+\swrote:|Vào\s.+\sđã viết:|-{2,}\s*(?:Original Message|Tin nhắn gốc)\s*-{2,})\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+SIGNATURE_PATTERN = re.compile(
+    r"^\s*(?:Sent from my .+|Gửi từ .+ của tôi|Trân trọng,?|Best regards,?|Regards,?)\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+# "--" cũng hay được dùng làm đường kẻ phân cách trong note -> chỉ coi là chữ ký khi
+# nằm ngay trên phần trích dẫn của email, hoặc khối phía sau trông giống chữ ký
+SIGNATURE_DELIMITER_PATTERN = re.compile(r"^\s*--\s*$", re.MULTILINE)
+SIGNATURE_TASK_CUE_PATTERN = re.compile(
+    r"^\s*(?:[-*•+]|\[[ xX]?\]|\d+[.)])\s"
+    r"|\b(?:thứ|ngày|mai|tuần|tháng|deadline|trước|cần|phải|nhớ|gửi|làm|họp|gọi|mua|nộp|hoàn thành|việc|todo)\b",
+    re.IGNORECASE
+)
+SIGNATURE_MAX_LINES = 6
+SIGNATURE_MAX_LINE_CHARS = 60
+
+
+def _url_placeholder(url: str) -> str:
+    domain = re.sub(r"^(?:https?://)?(?:www\.)?", "", url).split("/")[0]
+    return f"[link: {domain}]"
+
+
+def _compact_markdown_images(text: str) -> str:
+    return MARKDOWN_IMAGE_PATTERN.sub(lambda m: f"[ảnh: {m.group(1)}]" if m.group(1) else "[ảnh]", text)
+
+
+def _compact_urls(text: str) -> str:
+    def shorten(url: str) -> str:
+        return _url_placeholder(url) if len(url) > Config.COMPACTION_URL_MAX_CHARS else url
+    
+    text = MARKDOWN_LINK_PATTERN.sub(lambda m: f"{m.group(1)} {shorten(m.group(2))}", text)
+    return URL_PATTERN.sub(lambda m: shorten(m.group(0)), text)
+
+
+def _strip_quoted_thread(text: str) -> str:
+    """Bỏ phần email được trích dẫn: từ dòng "On ... wrote:" trở đi, hoặc khối ">" liền nhau ở cuối note.
+    Dòng ">" nằm giữa nội dung (vd "> 5 người") được giữ nguyên"""
+    match = QUOTED_THREAD_PATTERN.search(text)
+    if match:
+        # Email trả lời: "--" ngay trên phần trích dẫn là chữ ký của người trả lời
+        text = text[:match.start()]
+        delimiters = list(SIGNATURE_DELIMITER_PATTERN.finditer(text))
+        if delimiters and text[delimiters[-1].end():].strip().count("\n") < SIGNATURE_MAX_LINES \
+                and text[:delimiters[-1].start()].strip():
+            return text[:delimiters[-1].start()]
+        return text
+    lines = text.split("\n")
+    end = len(lines)
+    while end and (not lines[end - 1].strip() or lines[end - 1].lstrip().startswith(">")):
+        end -= 1
+    if any(line.lstrip().startswith(">") for line in lines[end:]):
+        return "\n".join(lines[:end])
+    return text
+
+
+def _looks_like_signature(block: str) -> bool:
+    """Vài dòng ngắn (tên, chức danh, số điện thoại...), không có câu nào giống task"""
+    lines = [line for line in block.split("\n") if line.strip()]
+    return 0 < len(lines) <= SIGNATURE_MAX_LINES and all(
+        len(line.strip()) <= SIGNATURE_MAX_LINE_CHARS and not SIGNATURE_TASK_CUE_PATTERN.search(line)
+        for line in lines
+    )
+
+
+def _strip_signature(text: str) -> str:
+    """Bỏ chữ ký ở cuối note (chỉ khi marker nằm trong vài dòng cuối; "--" chỉ khi phía sau trông giống chữ ký)"""
+    for match in reversed(list(SIGNATURE_PATTERN.finditer(text))):
+        if text[match.end():].count("\n") <= SIGNATURE_MAX_LINES and text[:match.start()].strip():
+            return text[:match.start()]
+    for match in reversed(list(SIGNATURE_DELIMITER_PATTERN.finditer(text))):
+        if text[:match.start()].strip() and _looks_like_signature(text[match.end():]):
+            return text[:match.start()]
+    return text
+
+
+def _collapse_whitespace(text: str) -> str:
+    lines = [re.sub(r"[ \t\u00a0]+", " ", line).strip() for line in text.split("\n")]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+COMPACTION_RULES = {
+    "markdown_images": _compact_markdown_images,
+    "urls": _compact_urls,
+    "quoted_thread": _strip_quoted_thread,
+    "signature": _strip_signature,
+    "whitespace": _collapse_whitespace
+}
+
+
+class InputCompactor:
+    """
+    Chuẩn bị text trước khi đưa vào prompt:
+    1. Chạy các rule nén (theo thứ tự cấu hình)
+    2. Áp token budget của endpoint: cắt bớt (truncate) hoặc chia nhiều chunk (chunk)
+    Ghi lại số token trước / sau theo endpoint để xem qua /api/config.
+    """
+
+    def __init__(self, rules: List[str], budgets: Dict[str, int], strategies: Dict[str, str]):
+        unknown = [rule for rule in rules if rule not in COMPACTION_RULES]
+        if unknown:
+            raise ValueError(f"Unknown compaction rules: {unknown}")
+        self.rules = rules
+        self.budgets = budgets
+        self.strategies = strategies
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {
+            "requests": 0, "original_tokens": 0, "compacted_tokens": 0,
+            "final_tokens": 0, "truncated": 0, "chunked": 0
+        })
+
+    def compact(self, text: str) -> str:
+        for rule in self.rules:
+            text = COMPACTION_RULES[rule](text)
+        return text
+
+    def prepare(self, endpoint: str, text: str) -> tuple:
+        """Trả về (text đã nén, danh sách chunks để gửi LLM, thống kê token)"""
+        original_tokens = count_tokens(text)
+        compacted = self.compact(text) or text
+        compacted_tokens = count_tokens(compacted)
+        budget = self.budgets.get(endpoint)
+        strategy = "none"
+        chunks = [compacted]
+        
+        if budget is not None and compacted_tokens > budget:
+            strategy = self.strategies.get(endpoint, "truncate")
+            if strategy == "chunk":
+                chunks = self._chunk(compacted, budget)[:Config.MAX_INPUT_CHUNKS]
+            else:
+                chunks = [truncate_to_tokens(compacted, budget)]
+        
+        final_tokens = compacted_tokens if strategy == "none" else sum(count_tokens(c) for c in chunks)
+        with self._lock:
+            stats = self._stats[endpoint]
+            stats["requests"] += 1
+            stats["original_tokens"] += original_tokens
+            stats["compacted_tokens"] += compacted_tokens
+            stats["final_tokens"] += final_tokens
+            stats["truncated"] += strategy == "truncate"
+            stats["chunked"] += strategy == "chunk"
+        
+        return compacted, chunks, {
+            "original_tokens": original_tokens,
+            "compacted_tokens": compacted_tokens,
+            "final_tokens": final_tokens,
+            "budget": budget,
+            "strategy": strategy,
+            "chunks": len(chunks),
+            "counter": token_counter_name()
+        }
+
+    @staticmethod
+    def _chunk(text: str, budget: int) -> List[str]:
+        """Chia theo câu / dòng, gộp lại thành các chunk <= budget token"""
+        pieces = []
+        for piece in re.split(r"(?<=[.!?;\n])\s+", text):
+            while count_tokens(piece) > budget:
+                head = truncate_to_tokens(piece, budget)
+                pieces.append(head)
+                piece = piece[len(head):]
+            if piece.strip():
+                pieces.append(piece)
+        
+        chunks, current, current_tokens = [], [], 0
+        for piece in pieces:
+            tokens = count_tokens(piece) + 1  # + khoảng trắng nối giữa các câu
+            if current and current_tokens + tokens > budget:
+                chunks.append(" ".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+        if current:
+            chunks.append(" ".join(current))
+        return chunks
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                endpoint: {
+                    **stats,
+                    "saved_ratio": round(1 - stats["final_tokens"] / stats["original_tokens"], 3)
+                    if stats["original_tokens"] else None
+                }
+                for endpoint, stats in self._stats.items()
+            }
+
+
+# ==================== LOCAL TEXT MATCHING ====================
+def normalize_text(text: str) -> str:
+    """Lowercase, bỏ dấu tiếng Việt, bỏ dấu câu, gộp khoảng trắng"""
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    return " ".join(re.findall(r"[a-z0-9]+", text))
+
+
+def label_tokens(text: str) -> List[str]:
+    """Token để so khớp: từng âm tiết + cặp âm tiết liền nhau"""
+    words = normalize_text(text).split()
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+class LabelMatcher:
+    """
+    Chấm điểm lexical texts x labels (tên folder / area) bằng inverted index trên tên label.
+    Điểm của 1 label = tổng trọng số IDF các token của tên label xuất hiện
+    trong text / tổng trọng số token của tên label (0-1).
+    Cả ma trận được tính trong 1 lượt duyệt postings, không lặp lại labels cho từng text.
+    """
+
+    def __init__(self, labels: List[Dict]):
+        self.labels = labels
+        label_token_sets = [set(label_tokens(label["name"])) for label in labels]
+        df = Counter(tok for tokens in label_token_sets for tok in tokens)
+        
+        self._postings: Dict[str, List[tuple]] = defaultdict(list)
+        self._norms: List[float] = []
+        for idx, tokens in enumerate(label_token_sets):
+            total = 0.0
+            for tok in tokens:
+                weight = math.log(1 + len(labels) / df[tok])
+                self._postings[tok].append((idx, weight))
+                total += weight
+            self._norms.append(total)
+
+    def score_matrix(self, texts: List[str]) -> List[List[float]]:
+        matrix = []
+        for text in texts:
+            row = [0.0] * len(self.labels)
+            for tok in set(label_tokens(text)):
+                for idx, weight in self._postings.get(tok, ()):
+                    row[idx] += weight
+            matrix.append([
+                round(score / norm, 3) if norm else 0.0
+                for score, norm in zip(row, self._norms)
+            ])
+        return matrix
+
+    def confident_match(self, scores: List[float]) -> Optional[int]:
+        """Index label nếu điểm lexical đủ cao và bỏ xa label thứ 2, ngược lại None"""
+        if not scores:
+            return None
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+        best = scores[ranked[0]]
+        second = scores[ranked[1]] if len(ranked) > 1 else 0.0
+        if best >= Config.FOLDER_LOCAL_MATCH_SCORE and best - second >= Config.FOLDER_LOCAL_MARGIN:
+            return ranked[0]
+        return None
+
+
+# ==================== TAXONOMY (AREAS + FOLDERS) ====================
+class TaxonomyIndex:
+    """
+    Index fuzzy cho areas + folders của 1 user.
+    Resolve tên project/topic AI đề xuất về area/folder có sẵn, hoặc đánh dấu tạo mới.
+    """
+
+    def __init__(self, areas: List[Dict], folders: List[Dict], version: Optional[str] = None):
+        self.areas = areas
+        self.folders = folders
+        self.version = version or hashlib.sha1(json.dumps(
+            {"areas": areas, "folders": folders}, ensure_ascii=False, sort_keys=True
+        ).encode("utf-8")).hexdigest()[:16]
+        self._area_matcher = LabelMatcher(areas)
+        
+        folders_by_area: Dict[str, List[Dict]] = defaultdict(list)
+        for folder in folders:
+            folders_by_area[folder.get("areaId", "")].append(folder)
+        self._folder_matchers = {
+            area_id: LabelMatcher(area_folders) for area_id, area_folders in folders_by_area.items()
+        }
+
+    @staticmethod
+    def _best(matcher: LabelMatcher, terms: List[str]) -> tuple:
+        if not matcher.labels or not terms:
+            return None, 0.0
+        scores = matcher.score_matrix([" ".join(terms)])[0]
+        idx = max(range(len(scores)), key=lambda i: scores[i])
+        if scores[idx] < Config.PLACEMENT_MATCH_SCORE:
+            return None, scores[idx]
+        return matcher.labels[idx], scores[idx]
+
+    def place(self, projects: List[str], topics: List[str]) -> tuple:
+        """Trả về (area, folder) dạng PlacementTarget dict"""
+        terms = [t for t in projects + topics if t]
+        
+        area, area_score = self._best(self._area_matcher, terms)
+        if area is None:
+            area_target = {"id": None, "name": (projects + topics + ["General"])[0],
+                           "is_new": True, "score": area_score}
+            folder_matcher = None
+        else:
+            area_target = {"id": area["_id"], "name": area["name"], "is_new": False, "score": area_score}
+            folder_matcher = self._folder_matchers.get(area["_id"])
+        
+        folder, folder_score = self._best(folder_matcher, terms) if folder_matcher else (None, 0.0)
+        if folder is None:
+            folder_target = {"id": None, "name": (topics + projects + ["Notes"])[0],
+                             "is_new": True, "score": folder_score}
+        else:
+            folder_target = {"id": folder["_id"], "name": folder["name"], "is_new": False, "score": folder_score}
+        
+        return area_target, folder_target
+
+
+class TaxonomyStore:
+    """Cache LRU + TTL: user_id -> TaxonomyIndex"""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def put(self, user_id: str, areas: List[Dict], folders: List[Dict],
+            version: Optional[str] = None) -> TaxonomyIndex:
+        index = TaxonomyIndex(areas, folders, version)
+        with self._lock:
+            self._items[user_id] = (time.time(), index)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return index
+
+    def get(self, user_id: str) -> Optional[TaxonomyIndex]:
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                return None
+            registered_at, index = item
+            if time.time() - registered_at > self.ttl_seconds:
+                del self._items[user_id]
+                return None
+            self._items.move_to_end(user_id)
+            return index
+
+    def invalidate(self, user_id: str) -> bool:
+        with self._lock:
+            return self._items.pop(user_id, None) is not None
+
+
+# ==================== FOLDER SCORE STORE ====================
+class FolderScoreStore:
+    """
+    LRU + TTL: hash(note) -> {folder key: {"score", "reason"}}.
+    Folder key gồm id + tên, nên folder đổi tên được coi là folder mới cần chấm lại.
+    Khi danh sách folders thay đổi: chỉ các folder mới / đổi tên cần gọi LLM,
+    điểm của folder đã xóa bị bỏ, kết quả cuối được tính lại từ điểm đã gộp.
+    """
+
+    def __init__(self, max_notes: int, ttl_seconds: int):
+        self.max_notes = max_notes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+
+    @staticmethod
+    def note_key(text: str) -> str:
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    @staticmethod
+    def folder_key(folder: Dict) -> str:
+        return f"{folder.get('_id') or folder.get('id') or ''}\x1f{folder['name']}"
+
+    def _entry(self, note_key: str) -> Optional[Dict[str, Dict]]:
+        item = self._items.get(note_key)
+        if item is None:
+            return None
+        stored_at, scores = item
+        if time.time() - stored_at > self.ttl_seconds:
+            del self._items[note_key]
+            return None
+        self._items.move_to_end(note_key)
+        return scores
+
+    def missing(self, note_key: str, folders: List[Dict]) -> List[Dict]:
+        """Folders chưa có điểm cho note này; đồng thời bỏ điểm của các folder không còn tồn tại"""
+        current = {self.folder_key(f) for f in folders}
+        with self._lock:
+            scores = self._entry(note_key) or {}
+            for key in [key for key in scores if key not in current]:
+                del scores[key]
+            return [f for f in folders if self.folder_key(f) not in scores]
+
+    def merge(self, note_key: str, folders: List[Dict], scored_folders: Optional[List[Dict]] = None,
+              result: Optional[dict] = None) -> dict:
+        """Lưu điểm mới (kết quả LLM cho scored_folders) rồi tính lại kết quả trên toàn bộ folders"""
+        with self._lock:
+            scores = self._entry(note_key)
+            if scores is None:
+                scores = {}
+            if result is not None:
+                chosen = result["suggested_folder_name"] if result["found_match"] else None
+                for folder, item in zip(scored_folders, result["all_scores"]):
+                    scores[self.folder_key(folder)] = {
+                        "score": item["score"],
+                        "reason": result["reasoning"] if folder["name"] == chosen else None
+                    }
+                self._items[note_key] = (time.time(), scores)
+                self._items.move_to_end(note_key)
+                while len(self._items) > self.max_notes:
+                    self._items.popitem(last=False)
+            merged = [scores.get(self.folder_key(f), {"score": 0.0, "reason": None}) for f in folders]
+        
+        best = max(range(len(folders)), key=lambda idx: merged[idx]["score"])
+        confidence = min(max(float(merged[best]["score"]), 0.0), 1.0)
+        found_match = confidence >= Config.FOLDER_MATCH_THRESHOLD
+        if not found_match:
+            reasoning = result["reasoning"] if result is not None and not result["found_match"] \
+                else f"Không có folder nào đạt ngưỡng {Config.FOLDER_MATCH_THRESHOLD}"
+        else:
+            reasoning = merged[best]["reason"] or \
+                f"Folder \"{folders[best]['name']}\" có điểm cao nhất trong {len(folders)} folders"
+        
+        return {
+            "success": True,
+            "found_match": found_match,
+            "suggested_folder_name": folders[best]["name"] if found_match else None,
+            "confidence": confidence,
+            "reasoning": reasoning,
+            "all_scores": [
+                {"folder_name": f["name"], "score": item["score"]}
+                for f, item in zip(folders, merged)
+            ]
+        }
+
+
+# ==================== SEMANTIC CACHE ====================
+# Số đếm tiếng Việt -> chữ số, để "thứ 6" và "thứ sáu" có cùng shingles.
+# Sau khi bỏ dấu, "sau", "tu", "nam", "ba", "bay" là các âm tiết rất phổ biến (sau, từ, năm/Nam, bà, bay),
+# nên chỉ đổi khi đứng sau "thứ"/"ngày"/"tháng" hoặc nối tiếp 1 số đếm vừa được đổi ("ngày hai mươi").
+NUMBER_WORDS = {
+    "mot": "1", "hai": "2", "ba": "3", "bon": "4", "tu": "4", "nam": "5",
+    "sau": "6", "bay": "7", "tam": "8", "chin": "9", "muoi": "10"
+}
+NUMBER_CONTEXT_WORDS = {"thu", "ngay", "thang"}
+# Từ phủ định: so trên text còn dấu, vì bỏ dấu thì "đừng" trùng "dùng"/"đúng"
+NEGATION_WORDS = {"không", "chưa", "đừng", "chẳng", "ko"}
+MINHASH_PRIME = (1 << 61) - 1
+
+
+def _canonical_numbers(words: List[str]) -> List[str]:
+    result = []
+    prev_converted = False
+    for word in words:
+        digit = NUMBER_WORDS.get(word)
+        prev = result[-1] if result else ""
+        # "ngày sau" / "tháng sau" nghĩa là "sau đó" / "tháng tới", không phải số 6
+        after_context = prev in NUMBER_CONTEXT_WORDS and not (word == "sau" and prev != "thu")
+        converted = digit is not None and (after_context or prev_converted)
+        result.append(digit if converted else word)
+        prev_converted = converted
+    return result
+
+
+def note_shingles(text: str, size: int = Config.SEMANTIC_CACHE_SHINGLE_SIZE) -> set:
+    """Shingles ký tự trên text đã chuẩn hóa (hoa/thường, dấu, dấu câu, khoảng trắng, số đếm)"""
+    words = _canonical_numbers(normalize_text(text).split())
+    normalized = " ".join(words)
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+
+def note_exact_key(text: str) -> tuple:
+    """
+    Phần phải khớp tuyệt đối để được hit cache: các token có chữ số (số tiền, Q3/Q4, ngày,
+    "thứ sáu" -> "6") và các từ phủ định. Đổi 1 con số hay thêm "không" là đổi nghĩa note,
+    dù Jaccard vẫn rất cao.
+    """
+    numbers = tuple(
+        word for word in _canonical_numbers(normalize_text(text).split())
+        if any(ch.isdigit() for ch in word)
+    )
+    negations = tuple(
+        word for word in re.findall(r"\w+", unicodedata.normalize("NFC", text.lower()))
+        if word in NEGATION_WORDS
+    )
+    return numbers, negations
+
+
+class MinHasher:
+    """MinHash signature với các hàm băm (a*x + b) mod p, seed cố định"""
+
+    def __init__(self, num_perm: int, seed: int = 42):
+        rng = random.Random(seed)
+        self.params = [
+            (rng.randrange(1, MINHASH_PRIME), rng.randrange(0, MINHASH_PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, shingles: set) -> tuple:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "little")
+            for shingle in shingles
+        ] or [0]
+        return tuple(
+            min((a * h + b) % MINHASH_PRIME for h in hashes)
+            for a, b in self.params
+        )
+
+    @staticmethod
+    def similarity(sig_a: tuple, sig_b: tuple) -> float:
+        return sum(x == y for x, y in zip(sig_a, sig_b)) / len(sig_a)
+
+
+class SemanticCache:
+    """
+    Cache kết quả analyze theo độ giống nhau của note (MinHash + LSH banding).
+    - Entry và LSH buckets tách theo namespace (user_id): note của user này
+      không bao giờ trả về tasks trích từ note của user khác
+    - Trong namespace, buckets tách tiếp theo note_exact_key: note khác số / ngày /
+      phủ định không bao giờ là candidate của nhau
+    - Bộ nhớ bị chặn: LRU tối đa max_entries, hết TTL thì bỏ
+    - Hit khi Jaccard ước lượng >= threshold; tasks trả về có task_id mới
+    - 1 phần hit (audit_rate) được gọi lại upstream ở background để đo tỷ lệ false hit
+    """
+
+    def __init__(self, threshold: float, max_entries: int, ttl_seconds: int,
+                 num_perm: int, bands: int, audit_rate: float):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.audit_rate = audit_rate
+        self.hasher = MinHasher(num_perm)
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._buckets: Dict[tuple, set] = defaultdict(set)
+        self._audit_pool: Optional[ThreadPoolExecutor] = None
+        self.stats = {"lookups": 0, "hits": 0, "evictions": 0,
+                      "audited": 0, "false_hits": 0}
+        self.recent_false_hits = deque(maxlen=10)
+
+    def _band_keys(self, partition: tuple, signature: tuple) -> List[tuple]:
+        return [
+            (partition, band, signature[band * self.rows:(band + 1) * self.rows])
+            for band in range(self.bands)
+        ]
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band_key in self._band_keys(entry["partition"], entry["signature"]):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def lookup(self, namespace: str, note_text: str) -> tuple:
+        """Trả về (signature, entry_key, entry, similarity); entry None khi miss"""
+        signature = self.hasher.signature(note_shingles(note_text))
+        partition = (namespace, note_exact_key(note_text))
+        now = time.time()
+        with self._lock:
+            self.stats["lookups"] += 1
+            candidates = set()
+            for band_key in self._band_keys(partition, signature):
+                candidates.update(self._buckets.get(band_key, ()))
+            
+            best_key, best_sim = None, 0.0
+            for key in candidates:
+                entry = self._entries[key]
+                if now - entry["stored_at"] > self.ttl_seconds:
+                    self._remove(key)
+                    continue
+                sim = MinHasher.similarity(signature, entry["signature"])
+                if sim > best_sim:
+                    best_key, best_sim = key, sim
+            
+            if best_key is None or best_sim < self.threshold:
+                return signature, None, None, best_sim
+            
+            self.stats["hits"] += 1
+            self._entries.move_to_end(best_key)
+            return signature, best_key, self._entries[best_key], best_sim
+
+    def store(self, namespace: str, signature: tuple, note_text: str, result: dict):
+        key = hashlib.sha256(f"{namespace}\x00{note_text}".encode()).hexdigest()
+        partition = (namespace, note_exact_key(note_text))
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = {
+                "partition": partition,
+                "signature": signature,
+                "note_text": note_text,
+                "tasks": [dict(task) for task in result["tasks"]],
+                "metadata": dict(result["metadata"]),
+                "stored_at": time.time()
+            }
+            for band_key in self._band_keys(partition, signature):
+                self._buckets[band_key].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def should_audit(self) -> bool:
+        return random.random() < self.audit_rate
+
+    def submit_audit(self, fn, *args):
+        with self._lock:
+            if self._audit_pool is None:
+                self._audit_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cache-audit")
+        self._audit_pool.submit(fn, *args)
+
+    def record_audit(self, key: str, note_text: str, cached_tasks: List[Dict],
+                     fresh_result: dict, similarity: float):
+        """So sánh tasks cache với tasks gọi lại upstream; false hit thì bỏ entry"""
+        cached = note_shingles(" ".join(t["task_text"] for t in cached_tasks))
+        fresh = note_shingles(" ".join(t["task_text"] for t in fresh_result["tasks"]))
+        agreement = len(cached & fresh) / len(cached | fresh) if cached | fresh else 1.0
+        with self._lock:
+            self.stats["audited"] += 1
+            if agreement >= Config.SEMANTIC_CACHE_AUDIT_AGREEMENT:
+                return
+            self.stats["false_hits"] += 1
+            self.recent_false_hits.append({
+                "note_text": note_text[:200],
+                "cached_note_text": self._entries[key]["note_text"][:200] if key in self._entries else None,
+                "similarity": round(similarity, 3),
+                "task_agreement": round(agreement, 3),
+                "audited_at": datetime.utcnow().isoformat()
+            })
+            self._remove(key)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            lookups, hits, audited = self.stats["lookups"], self.stats["hits"], self.stats["audited"]
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "threshold": self.threshold,
+                "shared_across_users": Config.SEMANTIC_CACHE_SHARED,
+                "hit_rate": round(hits / lookups, 3) if lookups else None,
+                "false_hit_rate": round(self.stats["false_hits"] / audited, 3) if audited else None,
+                "recent_false_hits": list(self.recent_false_hits)
+            }
+
+
+# ==================== OPENAI SERVICE ====================
+class OpenAITaskAnalyzer:
+    """Service xử lý AI với OpenAI"""
+    
+    def __init__(self, api_key: Optional[str], cassette: Optional[LLMCassette] = None):
+        self.cassette = cassette
+        replaying = cassette is not None and cassette.mode == "replay"
+        if not api_key and not replaying:
+            raise ValueError("OPENAI_API_KEY is required")
+        self.client = None
+        if not replaying:
+            from openai import OpenAI  # import chậm (~0.5s): chỉ load khi tạo client, không load lúc import module
+            # max_retries=0: retry chỉ qua vòng lặp + _backoff để luôn tôn trọng Deadline
+            self.client = OpenAI(api_key=api_key, max_retries=0)
+        self.model = Config.MODEL
+        self.temperature = Config.TEMPERATURE
+        self.router = ModelRouter(Config.MODEL_TIERS)
+        self.latency = LatencyTracker(Config.LATENCY_WINDOW)
+        self.rate_limiter = None  # SharedRateLimiter khi chạy backfill
+        self.folder_scores = FolderScoreStore(Config.FOLDER_SCORE_CACHE_SIZE, Config.FOLDER_SCORE_TTL_SECONDS)
+        self.compactor = InputCompactor(Config.COMPACTION_RULES, Config.INPUT_TOKEN_BUDGETS,
+                                        Config.OVERSIZE_STRATEGY)
+        self.semantic_cache = SemanticCache(
+            threshold=Config.SEMANTIC_CACHE_THRESHOLD,
+            max_entries=Config.SEMANTIC_CACHE_MAX_ENTRIES,
+            ttl_seconds=Config.SEMANTIC_CACHE_TTL_SECONDS,
+            num_perm=Config.SEMANTIC_CACHE_PERMUTATIONS,
+            bands=Config.SEMANTIC_CACHE_BANDS,
+            audit_rate=Config.SEMANTIC_CACHE_AUDIT_RATE
+        ) if Config.SEMANTIC_CACHE_ENABLED else None
+    
+    def _chat_completion(self, endpoint: str, messages: List[Dict[str, str]],
+                         temperature: float, response_format: Dict[str, Any],
+                         model: Optional[str] = None, deadline: Optional[Deadline] = None) -> tuple:
+        """
+        Gọi OpenAI (hoặc cassette khi replay), trả về (content, usage).
+        Mọi request upstream đều đi qua đây để có thể record/replay.
+        Timeout của attempt = min(timeout thích ứng của endpoint, thời gian còn lại của deadline).
+        """
+        model = model or self.model
+        adaptive_timeout = timeout = self.latency.timeout_for(endpoint)
+        if deadline is not None:
+            deadline.check(Config.MIN_ATTEMPT_SECONDS)
+            timeout = min(timeout, deadline.remaining())
+        prompt_hash = None
+        if self.cassette is not None:
+            prompt_hash = LLMCassette.prompt_hash(model, temperature, messages)
+            if self.cassette.mode == "replay":
+                entry = self.cassette.replay(prompt_hash)
+                return entry["completion"], entry["usage"]
+        
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        
+        start = time.time()
+        try:
+            response = self.client.chat.completions.create(
+                model=model,
+                temperature=temperature,
+                messages=messages,
+                response_format=response_format,
+                timeout=timeout
+            )
+        except Exception as e:
+            self.router.observe(model, (time.time() - start) * 1000, ok=False)
+            if timeout >= adaptive_timeout and self._is_timeout(e):
+                # Latency thật >= timeout: ghi lại làm sample để p99 (và timeout) tăng theo
+                # khi upstream chậm đi, thay vì timeout mãi ở mức cũ vì không còn sample thành công
+                self.latency.observe(endpoint, timeout)
+            raise
+        latency_ms = (time.time() - start) * 1000
+        self.router.observe(model, latency_ms, ok=True)
+        self.latency.observe(endpoint, latency_ms / 1000)
+        
+        content = response.choices[0].message.content
+        usage = {
+            "prompt_tokens": response.usage.prompt_tokens,
+            "completion_tokens": response.usage.completion_tokens,
+            "total_tokens": response.usage.total_tokens
+        }
+        
+        if self.cassette is not None:
+            self.cassette.record(endpoint, prompt_hash, model, messages, content, usage, latency_ms)
+        
+        return content, usage
+    
+    @staticmethod
+    def _is_timeout(error: Exception) -> bool:
+        from openai import APITimeoutError
+        return isinstance(error, (APITimeoutError, TimeoutError))
+
+    def _construct_system_prompt(self) -> str:
+        """Tạo system prompt cho OpenAI - không giới hạn danh sách"""
+        return ANALYSIS_SYSTEM_PROMPT
+
+    def _construct_project_system_prompt(self) -> str:
+        """System prompt cho việc tạo project"""
+        return PROJECT_SYSTEM_PROMPT
+
     def _construct_user_prompt(self, note_text: str) -> str:
         """Tạo user prompt"""
         return f"""Phân tích ghi chú sau đây và trích xuất tất cả các công việc cần làm.
@@ -287,20 +1613,10 @@ GHI CHÚ:
 HÃY TỰ DO ĐỀ XUẤT tên dự án (suggested_project) và chủ đề (suggested_topic) PHÙ HỢP nhất cho từng task.
 Không bị giới hạn bởi bất kỳ danh sách nào - hãy sáng tạo dựa trên nội dung thực tế.
 
-Xuất ra JSON theo đúng định dạng sau (KHÔNG thêm markdown):
-{{
-  "success": true,
-  "tasks": [
-    {{
-      "task_id": "uuid-string",
-      "task_text": "Câu tiếng Việt hoàn chỉnh mô tả công việc cụ thể cần làm",
-      "estimated_time_minutes": 45,
-      "priority": "Medium",
-      "suggested_project": "Tên dự án bạn tự đề xuất - ngắn gọn, có ý nghĩa",
-      "suggested_topic": "Tên chủ đề bạn tự đề xuất - mô tả loại công việc"
-    }}
-  ]
-}}"""
+Xuất JSON dạng gọn với khóa ngắn:
+{{"t": [{{"x": "Câu tiếng Việt hoàn chỉnh mô tả công việc", "m": 45, "p": "M", "j": "Tên dự án", "c": "Tên chủ đề"}}]}}
+x = nội dung task, m = thời gian ước tính (phút), p = ưu tiên (L/M/H),
+j = dự án đề xuất (suggested_project), c = chủ đề đề xuất (suggested_topic)"""
 
     def _construct_project_user_prompt(self, project_description: str) -> str:
         """User prompt cho project creation"""
@@ -311,150 +1627,201 @@ Xuất ra JSON theo đúng định dạng sau (KHÔNG thêm markdown):
 MÔ TẢ DỰ ÁN:
 {project_description}
 
-Xuất ra JSON theo format (KHÔNG có markdown):
-{{
-  "success": true,
-  "project": {{
-    "name": "Tên dự án ngắn gọn",
-    "description": "Mô tả chi tiết",
-    "estimated_duration_days": 30,
-    "priority": "High",
-    "suggested_area": "Tên Area phù hợp",
-    "color": 5,
-    "icon": 10,
-    "energy_level": "medium"
-  }},
-  "tasks": [
-    {{
-      "task_text": "Task đầy đủ ít nhất 6 từ",
-      "estimated_time_minutes": 60,
-      "priority": "High",
-      "status": "todo",
-      "energy_level": "medium",
-      "suggested_topic": "Chủ đề",
-      "order": 1
-    }}
-  ]
-}}"""
-
-    def _validate_and_clean_response(self, content: str) -> dict:
-        """Validate và clean response từ OpenAI"""
-        content = content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
-        
+Xuất JSON dạng gọn với khóa ngắn:
+{{"p": {{"n": "Tên dự án", "d": "Mô tả chi tiết", "dd": 30, "p": "H", "a": "Tên Area", "co": 5, "ic": 10, "e": "m"}},
+ "t": [{{"x": "Task đầy đủ ít nhất 6 từ", "m": 60, "p": "H", "s": "t", "e": "m", "c": "Chủ đề", "o": 1}}]}}
+Project: n = name, d = description, dd = estimated_duration_days, p = priority (L/M/H),
+a = suggested_area, co = color (0-10), ic = icon (0-50), e = energy_level (l/m/h/u = low/medium/high/urgent)
+Task: x = task_text, m = estimated_time_minutes, p = priority (L/M/H),
+s = status (t/g/d/p = todo/doing/done/pending), e = energy_level (l/m/h/u), c = suggested_topic, o = order"""
+
+    def _expand_analysis_response(self, content: str) -> dict:
+        """Parse response dạng gọn và mở rộng về shape TaskExtracted"""
         try:
             data = json.loads(content)
         except json.JSONDecodeError as e:
             raise ValueError(f"Invalid JSON response: {e}")
         
-        if not isinstance(data, dict):
-            raise ValueError("Response must be a JSON object")
-        
-        if not data.get("success"):
-            raise ValueError("Response success field must be true")
-        
-        if "tasks" not in data or not isinstance(data["tasks"], list):
-            raise ValueError("Response must contain 'tasks' array")
-        
         validated_tasks = []
-        for idx, task in enumerate(data["tasks"]):
-            if "task_id" not in task or not task["task_id"]:
-                task["task_id"] = str(uuid.uuid4())
-            
+        for idx, task in enumerate(data["t"]):
             try:
-                validated_task = TaskExtracted(**task)
+                validated_task = TaskExtracted(
+                    task_id=str(uuid.uuid4()),
+                    task_text=task["x"],
+                    estimated_time_minutes=task["m"],
+                    priority=PRIORITY_CODES[task["p"]],
+                    suggested_project=task["j"],
+                    suggested_topic=task["c"]
+                )
                 validated_tasks.append(validated_task.dict())
             except Exception as e:
                 raise ValueError(f"Task {idx + 1} validation failed: {e}")
         
-        data["tasks"] = validated_tasks
-        return data
+        return {"success": True, "tasks": validated_tasks}
 
-    def _validate_project_response(self, content: str) -> dict:
-        """Validate response cho project creation"""
-        content = content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
-        
+    def _expand_project_response(self, content: str) -> dict:
+        """Parse response dạng gọn và mở rộng về shape ProjectInfo / TaskForProject"""
         try:
             data = json.loads(content)
         except json.JSONDecodeError as e:
             raise ValueError(f"Invalid JSON response: {e}")
         
-        if not isinstance(data, dict):
-            raise ValueError("Response must be a JSON object")
-        
-        if not data.get("success"):
-            raise ValueError("Response success field must be true")
-        
-        # Validate project info
-        if "project" not in data:
-            raise ValueError("Response must contain 'project' object")
-        
+        project = data["p"]
         try:
-            validated_project = ProjectInfo(**data["project"])
+            validated_project = ProjectInfo(
+                name=project["n"],
+                description=project["d"],
+                estimated_duration_days=project["dd"],
+                priority=PRIORITY_CODES[project["p"]],
+                suggested_area=project["a"],
+                color=project["co"],
+                icon=project["ic"],
+                energy_level=ENERGY_CODES[project["e"]]
+            )
         except Exception as e:
             raise ValueError(f"Project validation failed: {e}")
         
-        # Validate tasks
-        if "tasks" not in data or not isinstance(data["tasks"], list):
-            raise ValueError("Response must contain 'tasks' array")
-        
-        if len(data["tasks"]) < 3:
+        if len(data["t"]) < 3:
             raise ValueError("Project must have at least 3 tasks")
         
         validated_tasks = []
-        for idx, task in enumerate(data["tasks"]):
+        for idx, task in enumerate(data["t"]):
             try:
-                validated_task = TaskForProject(**task)
+                validated_task = TaskForProject(
+                    task_text=task["x"],
+                    estimated_time_minutes=task["m"],
+                    priority=PRIORITY_CODES[task["p"]],
+                    status=STATUS_CODES[task["s"]],
+                    energy_level=ENERGY_CODES[task["e"]],
+                    suggested_topic=task["c"],
+                    order=task["o"]
+                )
                 validated_tasks.append(validated_task.dict())
             except Exception as e:
                 raise ValueError(f"Task {idx + 1} validation failed: {e}")
         
-        data["project"] = validated_project.dict()
-        data["tasks"] = validated_tasks
-        return data
-
-    def analyze(self, note_text: str, retries: int = Config.MAX_RETRIES) -> dict:
+        return {"success": True, "project": validated_project.dict(), "tasks": validated_tasks}
+
+    @staticmethod
+    def _backoff(attempt: int, deadline: Optional[Deadline], last_error: Exception):
+        """Chờ trước khi retry; không retry nếu sau khi chờ không còn đủ thời gian"""
+        wait_time = 2 ** attempt
+        if deadline is None:
+            time.sleep(wait_time)
+            return
+        if deadline.remaining() - wait_time < Config.MIN_ATTEMPT_SECONDS:
+            raise DeadlineExceeded(f"No time left to retry. Last error: {last_error}")
+        deadline.sleep(wait_time)
+
+    @staticmethod
+    def _model_for_attempt(routing: Dict[str, Any], attempt: int) -> str:
+        """Attempt 1 dùng model được route, các attempt sau fallback sang tier khác"""
+        models = [routing["model"]] + routing["fallback_models"]
+        return models[min(attempt - 1, len(models) - 1)]
+
+    def analyze(self, note_text: str, retries: int = Config.MAX_RETRIES,
+                latency_budget_ms: Optional[float] = None, deadline: Optional[Deadline] = None,
+                user_id: Optional[str] = None) -> dict:
+        """Phân tích note và trích xuất tasks (nén input, qua semantic cache của user nếu bật)"""
+        text, chunks, input_stats = self.compactor.prepare("analyze", note_text)
+        namespace = "*" if Config.SEMANTIC_CACHE_SHARED else user_id
+        
+        if self.semantic_cache is None or namespace is None:
+            result = self._analyze_chunks(chunks, retries, latency_budget_ms, deadline)
+        else:
+            signature, key, entry, similarity = self.semantic_cache.lookup(namespace, text)
+            if entry is None:
+                result = self._analyze_chunks(chunks, retries, latency_budget_ms, deadline)
+                self.semantic_cache.store(namespace, signature, text, result)
+                result["metadata"]["cache"] = {"hit": False, "similarity": round(similarity, 3)}
+            else:
+                if self.semantic_cache.should_audit():
+                    self.semantic_cache.submit_audit(
+                        self._audit_cache_hit, key, text, chunks, entry["tasks"], similarity
+                    )
+                result = {
+                    "success": True,
+                    "tasks": [{**task, "task_id": str(uuid.uuid4())} for task in entry["tasks"]],
+                    "metadata": {
+                        **entry["metadata"],
+                        "tokens_used": 0,
+                        "completion_tokens": 0,
+                        "attempt": 0,
+                        "cache": {"hit": True, "similarity": round(similarity, 3)}
+                    }
+                }
+        
+        result["metadata"]["note_length"] = len(note_text)
+        result["metadata"]["input_tokens"] = input_stats
+        return result
+    
+    def _audit_cache_hit(self, key: str, note_text: str, chunks: List[str],
+                         cached_tasks: List[Dict], similarity: float):
+        """Chạy ở background: gọi upstream cho note đã hit cache để kiểm tra false hit"""
+        try:
+            fresh = self._analyze_chunks(chunks, Config.MAX_RETRIES, None, None)
+        except Exception as e:
+            print(f"⚠️ Semantic cache audit failed: {e}")
+            return
+        self.semantic_cache.record_audit(key, note_text, cached_tasks, fresh, similarity)
+    
+    def _analyze_chunks(self, chunks: List[str], retries: int, latency_budget_ms: Optional[float],
+                        deadline: Optional[Deadline]) -> dict:
+        """Note vượt token budget được chia chunk: phân tích song song rồi gộp tasks"""
+        if len(chunks) == 1:
+            return self._analyze_uncached(chunks[0], retries, latency_budget_ms, deadline)
+        
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            parts = list(pool.map(
+                lambda chunk: self._analyze_uncached(chunk, retries, latency_budget_ms, deadline),
+                chunks
+            ))
+        
+        tasks = [task for part in parts for task in part["tasks"]]
+        metadata = {
+            **parts[0]["metadata"],
+            "tokens_used": sum(part["metadata"]["tokens_used"] for part in parts),
+            "completion_tokens": sum(part["metadata"]["completion_tokens"] for part in parts),
+            "tasks_extracted": len(tasks),
+            "projects_discovered": list(set(task["suggested_project"] for task in tasks)),
+            "topics_discovered": list(set(task["suggested_topic"] for task in tasks)),
+            "attempt": max(part["metadata"]["attempt"] for part in parts)
+        }
+        return {"success": True, "tasks": tasks, "metadata": metadata}
+    
+    def _analyze_uncached(self, note_text: str, retries: int, latency_budget_ms: Optional[float],
+                          deadline: Optional[Deadline]) -> dict:
         """Phân tích note và trích xuất tasks"""
         system_prompt = self._construct_system_prompt()
         user_prompt = self._construct_user_prompt(note_text)
+        routing = self.router.route("analyze", count_tokens(note_text), latency_budget_ms)
         
         last_error = None
         
         for attempt in range(1, retries + 1):
             try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    temperature=self.temperature,
+                model = self._model_for_attempt(routing, attempt)
+                content, usage = self._chat_completion(
+                    endpoint="analyze",
+                    model=model,
+                    response_format=ANALYSIS_RESPONSE_FORMAT,
                     messages=[
                         {"role": "system", "content": system_prompt},
                         {"role": "user", "content": user_prompt}
                     ],
-                    response_format={"type": "json_object"},
-                    timeout=Config.TIMEOUT
+                    temperature=self.temperature,
+                    deadline=deadline
                 )
-                
-                content = response.choices[0].message.content
-                result = self._validate_and_clean_response(content)
+                result = self._expand_analysis_response(content)
                 
                 projects = list(set(task['suggested_project'] for task in result['tasks']))
                 topics = list(set(task['suggested_topic'] for task in result['tasks']))
                 
                 result["metadata"] = {
-                    "model": self.model,
-                    "tokens_used": response.usage.total_tokens,
+                    "model": model,
+                    "routing": routing,
+                    "tokens_used": usage["total_tokens"],
+                    "completion_tokens": usage["completion_tokens"],
                     "note_length": len(note_text),
                     "tasks_extracted": len(result["tasks"]),
                     "projects_discovered": projects,
@@ -464,64 +1831,72 @@ Xuất ra JSON theo format (KHÔNG có markdown):
                 
                 return result
                 
+            except DeadlineExceeded:
+                raise
             except Exception as e:
                 last_error = e
                 if attempt < retries:
-                    wait_time = 2 ** attempt
-                    time.sleep(wait_time)
+                    self._backoff(attempt, deadline, e)
                     continue
         
         raise Exception(f"Failed after {retries} attempts. Last error: {last_error}")
 
-    def create_project(self, project_description: str, retries: int = Config.MAX_RETRIES) -> dict:
+    def create_project(self, project_description: str, retries: int = Config.MAX_RETRIES,
+                       latency_budget_ms: Optional[float] = None, deadline: Optional[Deadline] = None) -> dict:
         """Tạo project mới với AI"""
+        _, chunks, input_stats = self.compactor.prepare("create_project", project_description)
         system_prompt = self._construct_project_system_prompt()
-        user_prompt = self._construct_project_user_prompt(project_description)
+        user_prompt = self._construct_project_user_prompt(chunks[0])
+        routing = self.router.route("create_project", input_stats["final_tokens"], latency_budget_ms)
         
         last_error = None
         
         for attempt in range(1, retries + 1):
             try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    temperature=self.temperature,
+                model = self._model_for_attempt(routing, attempt)
+                content, usage = self._chat_completion(
+                    endpoint="create_project",
+                    model=model,
+                    response_format=PROJECT_RESPONSE_FORMAT,
                     messages=[
                         {"role": "system", "content": system_prompt},
                         {"role": "user", "content": user_prompt}
                     ],
-                    response_format={"type": "json_object"},
-                    timeout=Config.TIMEOUT
+                    temperature=self.temperature,
+                    deadline=deadline
                 )
-                
-                content = response.choices[0].message.content
-                result = self._validate_project_response(content)
+                result = self._expand_project_response(content)
                 
                 # Extract unique topics
                 topics = list(set(task['suggested_topic'] for task in result['tasks']))
                 
                 result["metadata"] = {
-                    "model": self.model,
-                    "tokens_used": response.usage.total_tokens,
+                    "model": model,
+                    "routing": routing,
+                    "tokens_used": usage["total_tokens"],
+                    "completion_tokens": usage["completion_tokens"],
                     "description_length": len(project_description),
                     "tasks_created": len(result["tasks"]),
                     "topics_discovered": topics,
-                    "attempt": attempt
+                    "attempt": attempt,
+                    "input_tokens": input_stats
                 }
                 
                 return result
                 
+            except DeadlineExceeded:
+                raise
             except Exception as e:
                 last_error = e
                 if attempt < retries:
-                    wait_time = 2 ** attempt
-                    time.sleep(wait_time)
+                    self._backoff(attempt, deadline, e)
                     continue
         
         raise Exception(f"Failed after {retries} attempts. Last error: {last_error}")
 
     def _construct_folder_suggestion_prompt(self, text: str, folders: List[Dict]) -> str:
         """System prompt cho folder suggestion"""
-        folder_list = "\n".join([f"- {f['name']}" for f in folders])
+        folder_list = "\n".join([f"{idx}. {f['name']}" for idx, f in enumerate(folders, 1)])
         
         return f"""Bạn là AI chuyên gia phân loại nội dung tiếng Việt vào các thư mục (folders).
 
@@ -534,7 +1909,7 @@ Xuất ra JSON theo format (KHÔNG có markdown):
     QUY TẮC:
     1. So sánh nội dung note với TÊN của từng folder
     2. Tìm folder có tên KHỚP NHẤT về chủ đề/lĩnh vực
-    3. Nếu KHÔNG có folder nào phù hợp (confidence < 0.6), trả về found_match = false
+    3. Nếu KHÔNG có folder nào phù hợp (confidence < 0.6), trả về i = 0
     4. Chỉ đề xuất folder khi THỰC SỰ có sự liên quan rõ ràng
 
     CHI TIẾT PHÂN TÍCH:
@@ -544,28 +1919,45 @@ Xuất ra JSON theo format (KHÔNG có markdown):
     - Chọn folder có điểm cao nhất (nếu >= 0.6)
 
     QUAN TRỌNG:
-    - Chỉ xuất JSON hợp lệ, KHÔNG có markdown
-    - Phải giải thích rõ ràng lý do chọn/không chọn
-    - Liệt kê điểm số của TẤT CẢ folders để người dùng hiểu
-
-    Format JSON output:
-    {{
-    "success": true,
-    "found_match": true/false,
-    "suggested_folder_name": "Tên folder được chọn" hoặc null,
-    "confidence": 0.85,
-    "reasoning": "Giải thích chi tiết tại sao chọn folder này hoặc tại sao không tìm thấy",
-    "all_scores": [
-        {{
-        "folder_name": "Tên folder",
-        "score": 0.85,
-        "reason": "Lý do cụ thể"
-        }}
-    ]
-    }}"""
+    - Giải thích ngắn gọn lý do chọn/không chọn
+    - Chấm điểm TẤT CẢ folders theo đúng thứ tự danh sách
+
+    Xuất JSON dạng gọn với khóa ngắn:
+    {{"i": 1, "c": 0.85, "r": "Lý do ngắn gọn", "s": [0.85, 0.1]}}
+    i = số thứ tự folder được chọn (1-{len(folders)}), 0 nếu không có folder phù hợp
+    c = confidence (0-1), r = reasoning, s = điểm (0-1) của từng folder theo thứ tự danh sách"""
+
+    def _expand_folder_response(self, content: str, folders: List[Dict]) -> dict:
+        """Parse response dạng gọn và mở rộng về shape folder suggestion"""
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON response: {e}")
+        
+        return self._expand_folder_result(data, folders)
+
+    def _expand_folder_result(self, data: dict, folders: List[Dict]) -> dict:
+        scores = list(data["s"])[:len(folders)]
+        scores += [0.0] * (len(folders) - len(scores))
+        confidence = min(max(float(data["c"]), 0.0), 1.0)
+        index = data["i"]
+        found_match = 1 <= index <= len(folders) and confidence >= Config.FOLDER_MATCH_THRESHOLD
+        
+        return {
+            "success": True,
+            "found_match": found_match,
+            "suggested_folder_name": folders[index - 1]["name"] if found_match else None,
+            "confidence": confidence,
+            "reasoning": data["r"],
+            "all_scores": [
+                {"folder_name": f["name"], "score": score}
+                for f, score in zip(folders, scores)
+            ]
+        }
 
-    def suggest_folder(self, text: str, folders: List[Dict], retries: int = Config.MAX_RETRIES) -> dict:
-        """Gợi ý folder phù hợp cho note"""
+    def suggest_folder(self, text: str, folders: List[Dict], retries: int = Config.MAX_RETRIES,
+                       latency_budget_ms: Optional[float] = None, deadline: Optional[Deadline] = None) -> dict:
+        """Gợi ý folder phù hợp cho note - chỉ chấm điểm các folder chưa có điểm cho note này"""
         if not folders or len(folders) == 0:
             return {
                 "success": True,
@@ -576,68 +1968,450 @@ Xuất ra JSON theo format (KHÔNG có markdown):
                 "all_scores": []
             }
         
+        _, chunks, input_stats = self.compactor.prepare("suggest_folder", text)
+        note_key = FolderScoreStore.note_key(chunks[0])
+        missing = self.folder_scores.missing(note_key, folders)
+        
+        if not missing:
+            result = self.folder_scores.merge(note_key, folders)
+            result["metadata"] = {"source": "cache", "tokens_used": 0, "completion_tokens": 0}
+        else:
+            scored = self._score_folders(chunks[0], missing, input_stats, retries, latency_budget_ms, deadline)
+            result = self.folder_scores.merge(note_key, folders, missing, scored)
+            result["metadata"] = {"source": "llm", **scored["metadata"]}
+        
+        result["metadata"].update({
+            "text_length": len(text),
+            "folders_analyzed": len(missing),
+            "folders_reused": len(folders) - len(missing),
+            "input_tokens": input_stats
+        })
+        return result
+
+    def _score_folders(self, text: str, folders: List[Dict], input_stats: Dict[str, Any], retries: int,
+                       latency_budget_ms: Optional[float], deadline: Optional[Deadline]) -> dict:
+        """Gọi LLM chấm điểm note (đã nén) với danh sách folders cho trước"""
         system_prompt = self._construct_folder_suggestion_prompt(text, folders)
         user_prompt = f"""NỘI DUNG NOTE:
     {text}
 
     Hãy phân tích và đề xuất folder phù hợp nhất từ danh sách trên."""
+        routing = self.router.route(
+            "suggest_folder",
+            input_stats["final_tokens"] + count_tokens(" ".join(f['name'] for f in folders)),
+            latency_budget_ms
+        )
         
         last_error = None
         
         for attempt in range(1, retries + 1):
             try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    temperature=0.3,  # Tăng một chút để linh hoạt hơn
+                model = self._model_for_attempt(routing, attempt)
+                content, usage = self._chat_completion(
+                    endpoint="suggest_folder",
+                    model=model,
+                    response_format=FOLDER_RESPONSE_FORMAT,
                     messages=[
                         {"role": "system", "content": system_prompt},
                         {"role": "user", "content": user_prompt}
                     ],
-                    response_format={"type": "json_object"},
-                    timeout=Config.TIMEOUT
+                    temperature=0.3,  # Tăng một chút để linh hoạt hơn
+                    deadline=deadline
                 )
-                
-                content = response.choices[0].message.content
-                
-                # Clean markdown
-                content = content.strip()
-                if content.startswith("```json"):
-                    content = content[7:]
-                if content.startswith("```"):
-                    content = content[3:]
-                if content.endswith("```"):
-                    content = content[:-3]
-                content = content.strip()
-                
-                result = json.loads(content)
-                
-                # Validate response
-                if not isinstance(result, dict):
-                    raise ValueError("Response must be a JSON object")
-                
-                if "found_match" not in result:
-                    raise ValueError("Response must contain 'found_match' field")
+                result = self._expand_folder_response(content, folders)
                 
                 # Add metadata
                 result["metadata"] = {
-                    "model": self.model,
-                    "tokens_used": response.usage.total_tokens,
-                    "text_length": len(text),
-                    "folders_analyzed": len(folders),
+                    "model": model,
+                    "routing": routing,
+                    "tokens_used": usage["total_tokens"],
+                    "completion_tokens": usage["completion_tokens"],
                     "attempt": attempt
                 }
                 
                 return result
                 
+            except DeadlineExceeded:
+                raise
             except Exception as e:
                 last_error = e
                 if attempt < retries:
-                    wait_time = 2 ** attempt
-                    time.sleep(wait_time)
+                    self._backoff(attempt, deadline, e)
                     continue
         
         raise Exception(f"Failed after {retries} attempts. Last error: {last_error}")
 
+    def _construct_batch_folder_prompt(self, folders: List[Dict]) -> str:
+        """System prompt cho batch folder suggestion (danh sách folders chỉ gửi 1 lần)"""
+        folder_list = "\n".join([f"{idx}. {f['name']}" for idx, f in enumerate(folders, 1)])
+        
+        return f"""Bạn là AI chuyên gia phân loại nội dung tiếng Việt vào các thư mục (folders).
+
+    NHIỆM VỤ:
+    Với MỖI note được đánh số, tìm folder PHÙ HỢP NHẤT trong danh sách cho sẵn.
+
+    DANH SÁCH FOLDERS HIỆN CÓ:
+    {folder_list}
+
+    QUY TẮC:
+    1. So sánh nội dung từng note với TÊN của từng folder
+    2. Nếu KHÔNG có folder nào phù hợp (confidence < {Config.FOLDER_MATCH_THRESHOLD}), trả về i = 0
+    3. Chấm điểm TẤT CẢ folders theo đúng thứ tự danh sách
+    4. Trả về đúng 1 kết quả cho mỗi note
+
+    Xuất JSON dạng gọn với khóa ngắn:
+    {{"r": [{{"n": 1, "i": 1, "c": 0.85, "r": "Lý do ngắn gọn", "s": [0.85, 0.1]}}]}}
+    n = số thứ tự note, i = số thứ tự folder được chọn (1-{len(folders)}), 0 nếu không phù hợp
+    c = confidence (0-1), r = reasoning, s = điểm (0-1) của từng folder theo thứ tự danh sách"""
+
+    def _suggest_folder_pack(self, texts: List[str], folders: List[Dict], routing: Dict[str, Any],
+                             retries: int = Config.MAX_RETRIES, deadline: Optional[Deadline] = None) -> tuple:
+        """Gửi 1 nhóm notes ambiguous trong 1 request, trả về (kết quả theo thứ tự note, metadata)"""
+        system_prompt = self._construct_batch_folder_prompt(folders)
+        user_prompt = "NỘI DUNG CÁC NOTE:\n" + "\n".join(
+            f"[{idx}] {text}" for idx, text in enumerate(texts, 1)
+        )
+        
+        last_error = None
+        
+        for attempt in range(1, retries + 1):
+            try:
+                model = self._model_for_attempt(routing, attempt)
+                content, usage = self._chat_completion(
+                    endpoint="batch_suggest_folder",
+                    model=model,
+                    response_format=FOLDER_BATCH_RESPONSE_FORMAT,
+                    messages=[
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    temperature=0.3,
+                    deadline=deadline
+                )
+                data = json.loads(content)
+                
+                results: List[Optional[dict]] = [None] * len(texts)
+                for item in data["r"]:
+                    if 1 <= item["n"] <= len(texts):
+                        results[item["n"] - 1] = self._expand_folder_result(item, folders)
+                
+                metadata = {
+                    "model": model,
+                    "tokens_used": usage["total_tokens"],
+                    "completion_tokens": usage["completion_tokens"],
+                    "pack_size": len(texts),
+                    "attempt": attempt
+                }
+                return results, metadata
+                
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                last_error = e
+                if attempt < retries:
+                    self._backoff(attempt, deadline, e)
+                    continue
+        
+        raise Exception(f"Failed after {retries} attempts. Last error: {last_error}")
+
+    def suggest_folders_batch(self, texts: List[str], folders: List[Dict],
+                              latency_budget_ms: Optional[float] = None,
+                              deadline: Optional[Deadline] = None) -> List[dict]:
+        """
+        Gợi ý folder cho nhiều notes:
+        1. Chấm điểm lexical toàn bộ ma trận notes x folders
+        2. Notes khớp chắc chắn -> trả kết quả ngay, không gọi LLM
+        3. Notes ambiguous -> gộp thành từng nhóm gửi LLM
+        """
+        if not folders:
+            return [{
+                "success": True,
+                "found_match": False,
+                "suggested_folder_name": None,
+                "confidence": 0.0,
+                "reasoning": "Không có folder nào để so sánh",
+                "all_scores": [],
+                "metadata": {"source": "local"}
+            } for _ in texts]
+        
+        prepared = [self.compactor.prepare("suggest_folder", text) for text in texts]
+        texts = [chunks[0] for _, chunks, _ in prepared]
+        
+        matcher = LabelMatcher(folders)
+        matrix = matcher.score_matrix(texts)
+        results: List[Optional[dict]] = [None] * len(texts)
+        ambiguous = []
+        
+        for idx, scores in enumerate(matrix):
+            match = matcher.confident_match(scores)
+            if match is None:
+                ambiguous.append(idx)
+                continue
+            results[idx] = {
+                "success": True,
+                "found_match": True,
+                "suggested_folder_name": folders[match]["name"],
+                "confidence": scores[match],
+                "reasoning": f"Nội dung note khớp rõ với tên folder \"{folders[match]['name']}\"",
+                "all_scores": [
+                    {"folder_name": f["name"], "score": score}
+                    for f, score in zip(folders, scores)
+                ],
+                "metadata": {"source": "local", "folders_analyzed": len(folders)}
+            }
+        
+        # Notes ambiguous: dùng lại điểm đã chấm, chỉ gửi LLM các folder còn thiếu,
+        # gom các notes thiếu cùng 1 nhóm folders (thường là các folder vừa thêm) vào chung pack
+        note_keys = [FolderScoreStore.note_key(text) for text in texts]
+        delta_groups: Dict[tuple, List[int]] = defaultdict(list)
+        folder_by_key = {FolderScoreStore.folder_key(f): f for f in folders}
+        for idx in ambiguous:
+            missing = self.folder_scores.missing(note_keys[idx], folders)
+            if not missing:
+                result = self.folder_scores.merge(note_keys[idx], folders)
+                result["metadata"] = {"source": "cache", "folders_analyzed": 0, "folders_reused": len(folders)}
+                results[idx] = result
+                continue
+            delta_groups[tuple(FolderScoreStore.folder_key(f) for f in missing)].append(idx)
+        
+        pack_size = Config.FOLDER_BATCH_PACK_SIZE
+        packs = [
+            ([folder_by_key[key] for key in delta_keys], indices[start:start + pack_size])
+            for delta_keys, indices in delta_groups.items()
+            for start in range(0, len(indices), pack_size)
+        ]
+        
+        def run_pack(delta_folders: List[Dict], pack: List[int]):
+            pack_texts = [texts[idx] for idx in pack]
+            routing = self.router.route(
+                "suggest_folder",
+                count_tokens(" ".join(pack_texts) + " ".join(f['name'] for f in delta_folders)),
+                latency_budget_ms
+            )
+            try:
+                pack_results, pack_metadata = self._suggest_folder_pack(
+                    pack_texts, delta_folders, routing, deadline=deadline
+                )
+                return pack_results, pack_metadata, routing, None
+            except Exception as e:
+                return [None] * len(pack), {}, routing, e
+        
+        # Các pack độc lập nhau: gửi song song (có giới hạn), dùng chung deadline của request
+        if packs:
+            with ThreadPoolExecutor(max_workers=min(Config.FOLDER_BATCH_CONCURRENCY, len(packs))) as pool:
+                outcomes = list(pool.map(lambda item: run_pack(*item), packs))
+        else:
+            outcomes = []
+        
+        for (delta_folders, pack), (pack_results, pack_metadata, routing, error) in zip(packs, outcomes):
+            for idx, scored in zip(pack, pack_results):
+                if scored is None:
+                    # LLM lỗi hoặc bỏ sót note: trả điểm lexical, không kết luận
+                    result = {
+                        "success": error is None,
+                        "found_match": False,
+                        "suggested_folder_name": None,
+                        "confidence": 0.0,
+                        "reasoning": f"AI không trả kết quả cho note này: {error}" if error
+                                     else "AI không trả kết quả cho note này",
+                        "all_scores": [
+                            {"folder_name": f["name"], "score": score}
+                            for f, score in zip(folders, matrix[idx])
+                        ]
+                    }
+                    source = "local_fallback"
+                else:
+                    result = self.folder_scores.merge(note_keys[idx], folders, delta_folders, scored)
+                    source = "llm"
+                result["metadata"] = {
+                    "source": source,
+                    "folders_analyzed": len(delta_folders),
+                    "folders_reused": len(folders) - len(delta_folders),
+                    "routing": routing,
+                    **pack_metadata
+                }
+                results[idx] = result
+        
+        for result, (_, _, input_stats) in zip(results, prepared):
+            result["metadata"]["input_tokens"] = input_stats
+        return results
+
+# ==================== IDEMPOTENCY ====================
+class IdempotencyStore:
+    """
+    Lưu kết quả theo (endpoint, Idempotency-Key) trong TTL:
+    - key lặp lại + cùng body: trả kết quả đã lưu, hoặc chờ chung computation đang chạy
+    - key lặp lại + body khác: 422
+    - computation lỗi: không lưu, lần retry sau sẽ chạy lại
+    """
+
+    def __init__(self, ttl_seconds: int, max_keys: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_keys = max_keys
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    @staticmethod
+    def request_hash(request: BaseModel) -> str:
+        payload = json.dumps(request.dict(), ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _purge(self, now: float):
+        while self._items:
+            _, (created_at, _, _) = next(iter(self._items.items()))
+            if now - created_at <= self.ttl_seconds and len(self._items) <= self.max_keys:
+                break
+            self._items.popitem(last=False)
+
+    async def run(self, endpoint: str, key: Optional[str], request: BaseModel, compute) -> tuple:
+        """Trả về (kết quả, replayed). compute: coroutine function không tham số"""
+        if not key:
+            return await compute(), False
+        
+        now = time.time()
+        self._purge(now)
+        body_hash = self.request_hash(request)
+        item_key = (endpoint, key)
+        
+        item = self._items.get(item_key)
+        if item is not None:
+            _, stored_hash, future = item
+            if stored_hash != body_hash:
+                raise HTTPException(status_code=422, detail="Idempotency-Key reused with a different request body")
+            return await asyncio.shield(future), True
+        
+        future = asyncio.ensure_future(compute())
+        self._items[item_key] = (now, body_hash, future)
+        
+        def forget_on_error(done: asyncio.Future):
+            if done.cancelled() or done.exception() is not None:
+                if self._items.get(item_key, (None, None, None))[2] is done:
+                    del self._items[item_key]
+        
+        future.add_done_callback(forget_on_error)
+        # shield: client ngắt kết nối không hủy computation mà các retry đang chờ
+        return await asyncio.shield(future), False
+
+
+# ==================== CONTENT NEGOTIATION ====================
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = {MSGPACK_MEDIA_TYPE, "application/x-msgpack", "application/vnd.msgpack"}
+JSON_MEDIA_TYPES = {"application/json", "application/x-ndjson", "application/*", "*/*"}
+
+# Định dạng response của request hiện tại ("json" | "msgpack").
+# Endpoint streaming phải đọc giá trị này trước khi return, generator chạy sau khi route đã xong.
+wire_format: ContextVar[str] = ContextVar("wire_format", default="json")
+
+
+def _media_type(header_value: Optional[str]) -> str:
+    return (header_value or "").split(";")[0].strip().lower()
+
+
+def preferred_format(accept: Optional[str]) -> str:
+    """Chọn "json" hoặc "msgpack" theo header Accept (q-value cao nhất, bằng nhau thì lấy cái đứng trước)"""
+    best, best_q = "json", -1.0
+    for part in (accept or "").split(","):
+        media, *params = [p.strip() for p in part.split(";")]
+        media = media.lower()
+        if media in MSGPACK_MEDIA_TYPES and msgpack is not None:
+            fmt = "msgpack"
+        elif media in JSON_MEDIA_TYPES:
+            fmt = "json"
+        else:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = fmt, q
+    return best
+
+
+def encode_stream_item(item: Any, fmt: str) -> bytes:
+    """1 phần tử của response streaming: dòng NDJSON hoặc 1 object msgpack (nối tiếp nhau)"""
+    if fmt == "msgpack":
+        return msgpack.packb(jsonable_encoder(item))
+    if isinstance(item, BaseModel):
+        return (item.json() + "\n").encode()
+    return (json.dumps(item, ensure_ascii=False) + "\n").encode()
+
+
+def stream_media_type(fmt: str) -> str:
+    return MSGPACK_MEDIA_TYPE if fmt == "msgpack" else "application/x-ndjson"
+
+
+class MsgPackResponse(JSONResponse):
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content)
+
+
+def negotiated_response(request: Request, content: Any, status_code: int = 200) -> JSONResponse:
+    """Response cho exception handlers (chạy ngoài route nên tự đọc Accept)"""
+    if preferred_format(request.headers.get("accept")) == "msgpack":
+        return MsgPackResponse(status_code=status_code, content=content)
+    return JSONResponse(status_code=status_code, content=content)
+
+
+class NegotiatedRoute(APIRoute):
+    """
+    Route hỗ trợ application/msgpack bên cạnh JSON:
+    - Content-Type: application/msgpack -> body được decode bằng msgpack thay vì JSON
+    - Accept: application/msgpack -> response (kể cả streaming) encode bằng msgpack
+    Mỗi route giữ 2 handler dựng sẵn, nên response JSON vẫn đi fast path mặc định của FastAPI.
+    """
+
+    def get_route_handler(self):
+        json_handler = super().get_route_handler()
+        if msgpack is None:
+            msgpack_handler = json_handler
+        else:
+            response_class = self.response_class
+            self.response_class = MsgPackResponse
+            try:
+                msgpack_handler = super().get_route_handler()
+            finally:
+                self.response_class = response_class
+        
+        async def negotiated_handler(request: Request):
+            if _media_type(request.headers.get("content-type")) in MSGPACK_MEDIA_TYPES:
+                request = await self._decode_msgpack_body(request)
+            fmt = preferred_format(request.headers.get("accept"))
+            token = wire_format.set(fmt)
+            try:
+                if fmt == "msgpack":
+                    return await msgpack_handler(request)
+                return await json_handler(request)
+            finally:
+                wire_format.reset(token)
+        
+        return negotiated_handler
+
+    @staticmethod
+    async def _decode_msgpack_body(request: Request) -> Request:
+        if msgpack is None:
+            raise HTTPException(status_code=415, detail="application/msgpack is not supported (msgpack not installed)")
+        body = await request.body()
+        try:
+            decoded = msgpack.unpackb(body) if body else None
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid msgpack body: {e!r}")
+        
+        # Request mới với Content-Type JSON + body đã decode sẵn để FastAPI validate như JSON
+        scope = dict(request.scope)
+        scope["headers"] = [
+            (name, value) for name, value in request.scope["headers"] if name != b"content-type"
+        ] + [(b"content-type", b"application/json")]
+        decoded_request = Request(scope, request.receive)
+        decoded_request._body = body
+        decoded_request._json = decoded
+        return decoded_request
+
+
 # ==================== FASTAPI APP ====================
 app = FastAPI(
     title="Task Management AI API (Dynamic + Project Creation)",
@@ -646,6 +2420,7 @@ app = FastAPI(
     docs_url="/docs",
     redoc_url="/redoc"
 )
+app.router.route_class = NegotiatedRoute
 
 app.add_middleware(
     CORSMiddleware,
@@ -656,37 +2431,152 @@ app.add_middleware(
 )
 
 analyzer: Optional[OpenAITaskAnalyzer] = None
+taxonomy_store = TaxonomyStore(Config.TAXONOMY_CACHE_SIZE, Config.TAXONOMY_TTL_SECONDS)
+idempotency_store = IdempotencyStore(Config.IDEMPOTENCY_TTL_SECONDS, Config.IDEMPOTENCY_MAX_KEYS)
 
 
-# ==================== STARTUP ====================
-@app.on_event("startup")
-async def startup():
-    global analyzer
-    print("🚀 Starting Task Management AI Server (Dynamic + Project Creation)...")
+# ==================== STARTUP & WARM-UP ====================
+class StartupState:
+    """Thời gian từng bước khởi động + trạng thái warm-up (cho /ready và /live)"""
+
+    def __init__(self):
+        self.ready = False
+        self.error: Optional[str] = None
+        self.warnings: List[str] = []
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[f"{name}_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    def mark_ready(self):
+        self.ready = True
+        self.timings["time_to_ready_ms"] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+
+    def snapshot(self) -> dict:
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "warnings": self.warnings,
+            "timings": self.timings
+        }
+
+
+startup_state = StartupState()
+
+WARMUP_SAMPLE_NOTE = (
+    "Tuần này cần hoàn thành báo cáo Q4 trước thứ 6, xem https://docs.google.com/document/d/warmup "
+    "và gửi email cho khách hàng"
+)
+
+
+def warm_up(state: StartupState) -> OpenAITaskAnalyzer:
+    """
+    Các bước chạy nền trước khi nhận traffic:
+    1. Tạo analyzer (load openai SDK + client)
+    2. Load tokenizer local, chạy thử các rule nén / MinHash / label matcher
+    3. Mở sẵn kết nối upstream (DNS + TLS vào connection pool) để request đầu không bị chậm
+    """
+    with state.step("analyzer_init"):
+        warmed = OpenAITaskAnalyzer(api_key=Config.OPENAI_API_KEY, cassette=load_cassette())
+    
+    with state.step("tokenizer"):
+        count_tokens(WARMUP_SAMPLE_NOTE)
+    
+    with state.step("local_indexes"):
+        compacted = warmed.compactor.compact(WARMUP_SAMPLE_NOTE)
+        if warmed.semantic_cache is not None:
+            warmed.semantic_cache.hasher.signature(note_shingles(compacted))
+        LabelMatcher([{"name": "Báo cáo"}, {"name": "Công việc"}]).score_matrix([compacted])
+        warmed._construct_user_prompt(compacted)
+    
+    if warmed.client is not None and Config.WARMUP_UPSTREAM:
+        with state.step("upstream_connection"):
+            try:
+                # Truy cập client.chat.completions để SDK load sẵn các resource module
+                warmed.client.chat.completions
+                # with_options dùng chung http client (connection pool) với client chính
+                warmed.client.with_options(max_retries=0).models.retrieve(
+                    Config.MODEL, timeout=Config.WARMUP_TIMEOUT_SECONDS
+                )
+            except Exception as e:
+                # Upstream chưa kết nối được không chặn readiness: request thật vẫn có retry
+                state.warnings.append(f"Upstream warm-up failed: {e}")
     
+    return warmed
+
+
+async def _run_warm_up():
+    global analyzer
     try:
-        api_key = Config.OPENAI_API_KEY
-        if not api_key:
-            raise ValueError("OPENAI_API_KEY is required")
-        
-        analyzer = OpenAITaskAnalyzer(api_key=api_key)
-        print(f"✅ OpenAI service initialized (Model: {Config.MODEL})")
-        print(f"✅ Server ready at http://0.0.0.0:8000")
-        print(f"✅ API docs at http://0.0.0.0:8000/docs")
-        print(f"✨ Features: Dynamic labels + Project creation!")
-        
+        with startup_state.step("warm_up"):
+            warmed = await asyncio.to_thread(warm_up, startup_state)
     except Exception as e:
+        startup_state.error = str(e)
         print(f"❌ Failed to initialize: {e}")
-        raise
+        return
+    
+    analyzer = warmed
+    startup_state.mark_ready()
+    print(f"✅ OpenAI service initialized (Model: {Config.MODEL})")
+    if analyzer.cassette is not None:
+        print(f"📼 Cassette {analyzer.cassette.mode} mode: {analyzer.cassette.path}")
+    for warning in startup_state.warnings:
+        print(f"⚠️ {warning}")
+    print(f"⏱️ Startup timings: {startup_state.timings}")
+
+
+@app.on_event("startup")
+async def startup():
+    print("🚀 Starting Task Management AI Server (Dynamic + Project Creation)...")
+    # Không chặn startup: server nhận kết nối ngay (/live), /ready báo 503 cho đến khi warm-up xong
+    app.state.warm_up_task = asyncio.create_task(_run_warm_up())
+    print(f"✅ Server listening at http://0.0.0.0:8000 (traffic sau khi /ready = 200)")
+    print(f"✅ API docs at http://0.0.0.0:8000/docs")
+    print(f"✨ Features: Dynamic labels + Project creation!")
 
 
 # ==================== DEPENDENCIES ====================
 async def get_analyzer() -> OpenAITaskAnalyzer:
     if analyzer is None:
-        raise HTTPException(status_code=503, detail="Service not initialized")
+        detail = "Service not initialized" if startup_state.error else "Service warming up"
+        raise HTTPException(status_code=503, detail=detail)
     return analyzer
 
 
+async def _watch_disconnect(request: Request, deadline: Deadline):
+    while not deadline.cancelled:
+        if await request.is_disconnected():
+            deadline.cancel()
+            return
+        await asyncio.sleep(Config.DISCONNECT_POLL_SECONDS)
+
+
+async def get_deadline(
+    request: Request,
+    x_request_deadline_ms: Optional[float] = Header(None),
+    idempotency_key: Optional[str] = Header(None)
+):
+    """
+    Deadline từ header X-Request-Deadline-Ms (số ms caller còn chờ).
+    Hủy công việc khi client ngắt kết nối - trừ khi có Idempotency-Key,
+    vì lần retry của client có thể đang chờ chính kết quả này.
+    """
+    deadline = Deadline(x_request_deadline_ms / 1000 if x_request_deadline_ms is not None else None)
+    watcher = None
+    if not idempotency_key:
+        watcher = asyncio.create_task(_watch_disconnect(request, deadline))
+    try:
+        yield deadline
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+
 # ==================== ENDPOINTS ====================
 
 @app.get("/")
@@ -713,19 +2603,54 @@ async def health(analyzer: OpenAITaskAnalyzer = Depends(get_analyzer)):
     }
 
 
+@app.get("/live")
+async def live():
+    """Liveness: process còn chạy; chỉ fail khi khởi tạo lỗi không tự phục hồi được"""
+    if startup_state.error:
+        return JSONResponse(status_code=503, content={"status": "failed", "error": startup_state.error})
+    return {"status": "alive"}
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness: chỉ nhận traffic khi warm-up đã xong"""
+    if not startup_state.ready:
+        status = "failed" if startup_state.error else "warming_up"
+        return JSONResponse(status_code=503, content={"status": status, **startup_state.snapshot()})
+    return {"status": "ready", **startup_state.snapshot()}
+
+
 @app.post("/api/analyze", response_model=AnalysisResponse)
 async def analyze_note(
     request: NoteRequest,
-    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer)
+    response: Response,
+    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer),
+    x_latency_budget_ms: Optional[float] = Header(None),
+    deadline: Deadline = Depends(get_deadline),
+    idempotency_key: Optional[str] = Header(None)
 ):
     """
     Phân tích ghi chú và trích xuất tasks
     AI tự động đề xuất projects và topics
     """
+    result, replayed = await idempotency_store.run(
+        "analyze", idempotency_key, request,
+        lambda: _analyze_note(request, analyzer, x_latency_budget_ms, deadline)
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def _analyze_note(request: NoteRequest, analyzer: OpenAITaskAnalyzer,
+                        latency_budget_ms: Optional[float], deadline: Deadline) -> AnalysisResponse:
     start_time = time.time()
     
     try:
-        result = analyzer.analyze(note_text=request.text)
+        result = await asyncio.to_thread(
+            analyzer.analyze, note_text=request.text, latency_budget_ms=latency_budget_ms,
+            deadline=deadline, user_id=request.user_id
+        )
         
         tasks = []
         for task_data in result['tasks']:
@@ -754,15 +2679,151 @@ async def analyze_note(
             processing_time_ms=round(processing_time, 2)
         )
     
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"❌ Analysis error: {e}")
         raise HTTPException(status_code=500, detail=f"Analysis failed: {str(e)}")
 
 
+def _build_folder_suggestion_response(result: dict, folders: List[Dict], user_id: Optional[str],
+                                      processing_time: float) -> FolderSuggestionResponse:
+    """Chuyển kết quả analyzer thành FolderSuggestionResponse"""
+    # Tìm folder object từ tên
+    suggested_folder = None
+    if result.get("found_match") and result.get("suggested_folder_name"):
+        folder_name = result["suggested_folder_name"]
+        for folder in folders:
+            if folder["name"] == folder_name:
+                suggested_folder = folder
+                break
+    
+    metadata = result.get("metadata", {})
+    metadata.update({
+        "user_id": user_id,
+        "timestamp": datetime.utcnow().isoformat(),
+    })
+    
+    return FolderSuggestionResponse(
+        success=result.get("success", True),
+        found_match=result.get("found_match", False),
+        suggested_folder=suggested_folder,
+        confidence=result.get("confidence", 0.0),
+        reasoning=result.get("reasoning", ""),
+        all_scores=result.get("all_scores", []),
+        metadata=metadata,
+        processing_time_ms=round(processing_time, 2)
+    )
+
+
+@app.put("/api/taxonomy")
+async def register_taxonomy(request: TaxonomyRegistrationRequest):
+    """Đăng ký areas + folders của user để analyze-and-place không cần gửi lại mỗi lần"""
+    index = taxonomy_store.put(request.user_id, request.areas, request.folders, request.version)
+    return {
+        "success": True,
+        "user_id": request.user_id,
+        "version": index.version,
+        "areas": len(request.areas),
+        "folders": len(request.folders)
+    }
+
+
+@app.delete("/api/taxonomy/{user_id}")
+async def invalidate_taxonomy(user_id: str):
+    """Xóa taxonomy đã đăng ký (gọi khi user thêm/sửa/xóa area hoặc folder)"""
+    return {"success": True, "removed": taxonomy_store.invalidate(user_id)}
+
+
+@app.post("/api/analyze-and-place", response_model=AnalyzeAndPlaceResponse)
+async def analyze_and_place(
+    request: AnalyzeAndPlaceRequest,
+    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer),
+    x_latency_budget_ms: Optional[float] = Header(None),
+    deadline: Deadline = Depends(get_deadline)
+):
+    """
+    PHÂN TÍCH NOTE + XẾP VÀO AREA/FOLDER trong 1 request
+    
+    - Trích xuất tasks như /api/analyze
+    - Resolve project/topic AI đề xuất về area/folder có sẵn của user
+      (hoặc is_new = true nếu cần tạo mới)
+    - Taxonomy gửi kèm request hoặc dùng bản đã đăng ký qua PUT /api/taxonomy;
+      trả 409 nếu chưa đăng ký / đã hết hạn / khác taxonomy_version của caller
+      (cache nằm trong từng process, nên mỗi replica tự phát hiện bản cũ)
+    """
+    if request.taxonomy is not None:
+        index = taxonomy_store.put(
+            request.user_id, request.taxonomy.areas, request.taxonomy.folders,
+            request.taxonomy.version or request.taxonomy_version
+        )
+    else:
+        index = taxonomy_store.get(request.user_id)
+        if index is None:
+            raise HTTPException(status_code=409, detail="Taxonomy not registered for user")
+        if request.taxonomy_version is not None and index.version != request.taxonomy_version:
+            raise HTTPException(status_code=409, detail="Taxonomy version mismatch")
+    
+    start_time = time.time()
+    
+    try:
+        result = await asyncio.to_thread(
+            analyzer.analyze, note_text=request.text, latency_budget_ms=x_latency_budget_ms,
+            deadline=deadline, user_id=request.user_id
+        )
+        metadata = result['metadata']
+        
+        area, folder = index.place(metadata['projects_discovered'], metadata['topics_discovered'])
+        
+        tasks = []
+        for task_data in result['tasks']:
+            task_area, task_folder = index.place(
+                [task_data['suggested_project']], [task_data['suggested_topic']]
+            )
+            tasks.append(PlacedTaskResponse(
+                task_id=task_data['task_id'],
+                task_text=task_data['task_text'],
+                estimated_time_minutes=task_data['estimated_time_minutes'],
+                priority=task_data['priority'],
+                suggested_project=task_data['suggested_project'],
+                suggested_topic=task_data['suggested_topic'],
+                created_at=datetime.utcnow().isoformat(),
+                area=PlacementTarget(**task_area),
+                folder=PlacementTarget(**task_folder)
+            ))
+        
+        processing_time = (time.time() - start_time) * 1000
+        
+        metadata.update({
+            "taxonomy_version": index.version,
+            "user_id": request.user_id,
+            "timestamp": datetime.utcnow().isoformat(),
+        })
+        
+        return AnalyzeAndPlaceResponse(
+            success=True,
+            tasks=tasks,
+            area=PlacementTarget(**area),
+            folder=PlacementTarget(**folder),
+            metadata=metadata,
+            processing_time_ms=round(processing_time, 2)
+        )
+    
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        print(f"❌ Analyze-and-place error: {e}")
+        raise HTTPException(status_code=500, detail=f"Analyze-and-place failed: {str(e)}")
+
+
 @app.post("/api/suggest-folder", response_model=FolderSuggestionResponse)
 async def suggest_folder_for_note(
     request: FolderSuggestionRequest,
-    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer)
+    response: Response,
+    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer),
+    x_latency_budget_ms: Optional[float] = Header(None),
+    deadline: Deadline = Depends(get_deadline),
+    idempotency_key: Optional[str] = Header(None)
 ):
     """
     GỢI Ý FOLDER PHÙ HỢP CHO NOTE
@@ -785,50 +2846,124 @@ async def suggest_folder_for_note(
     }
 ```
     """
+    result, replayed = await idempotency_store.run(
+        "suggest_folder", idempotency_key, request,
+        lambda: _suggest_folder_for_note(request, analyzer, x_latency_budget_ms, deadline)
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def _suggest_folder_for_note(request: FolderSuggestionRequest, analyzer: OpenAITaskAnalyzer,
+                                   latency_budget_ms: Optional[float], deadline: Deadline) -> FolderSuggestionResponse:
     start_time = time.time()
     
     try:
-        result = analyzer.suggest_folder(
+        result = await asyncio.to_thread(
+            analyzer.suggest_folder,
             text=request.text,
-            folders=request.user_folders
+            folders=request.user_folders,
+            latency_budget_ms=latency_budget_ms,
+            deadline=deadline
         )
         
         processing_time = (time.time() - start_time) * 1000
         
-        # Tìm folder object từ tên
-        suggested_folder = None
-        if result.get("found_match") and result.get("suggested_folder_name"):
-            folder_name = result["suggested_folder_name"]
-            for folder in request.user_folders:
-                if folder["name"] == folder_name:
-                    suggested_folder = folder
-                    break
+        return _build_folder_suggestion_response(result, request.user_folders, request.user_id, processing_time)
+    
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        print(f"❌ Folder suggestion error: {e}")
+        raise HTTPException(status_code=500, detail=f"Folder suggestion failed: {str(e)}")
+    
+@app.post("/api/batch-suggest-folder", response_model=BatchFolderSuggestionResponse)
+async def batch_suggest_folder(
+    request: BatchFolderSuggestionRequest,
+    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer),
+    x_latency_budget_ms: Optional[float] = Header(None),
+    deadline: Deadline = Depends(get_deadline)
+):
+    """
+    GỢI Ý FOLDER CHO NHIỀU NOTES CÙNG LÚC
+    
+    - Danh sách folders chỉ gửi 1 lần cho cả batch
+    - Notes khớp rõ ràng với tên folder được xử lý local, không gọi AI
+    - Các notes còn lại được gộp nhóm và gửi AI trong ít request nhất
+    - Mỗi note trả về đúng shape của /api/suggest-folder
+    """
+    if len(request.notes) > Config.MAX_BATCH_FOLDER_NOTES:
+        raise HTTPException(status_code=400, detail=f"Maximum {Config.MAX_BATCH_FOLDER_NOTES} notes per batch")
+    
+    start_time = time.time()
+    
+    try:
+        results = await asyncio.to_thread(
+            analyzer.suggest_folders_batch,
+            texts=[note.text for note in request.notes],
+            folders=request.user_folders,
+            latency_budget_ms=x_latency_budget_ms,
+            deadline=deadline
+        )
         
-        metadata = result.get("metadata", {})
-        metadata.update({
-            "user_id": request.user_id,
-            "timestamp": datetime.utcnow().isoformat(),
-        })
+        processing_time = (time.time() - start_time) * 1000
         
-        return FolderSuggestionResponse(
-            success=result.get("success", True),
-            found_match=result.get("found_match", False),
-            suggested_folder=suggested_folder,
-            confidence=result.get("confidence", 0.0),
-            reasoning=result.get("reasoning", ""),
-            all_scores=result.get("all_scores", []),
-            metadata=metadata,
+        responses = []
+        for idx, (note, result) in enumerate(zip(request.notes, results)):
+            result.setdefault("metadata", {}).update({"index": idx, "note_id": note.note_id})
+            responses.append(_build_folder_suggestion_response(
+                result, request.user_folders, request.user_id, processing_time
+            ))
+        
+        sources = Counter(r.metadata.get("source") for r in responses)
+        return BatchFolderSuggestionResponse(
+            success=True,
+            results=responses,
+            metadata={
+                "total": len(responses),
+                "matched_locally": sources.get("local", 0),
+                "sent_to_llm": sources.get("llm", 0) + sources.get("local_fallback", 0),
+                "folders_analyzed": len(request.user_folders),
+                "user_id": request.user_id,
+                "timestamp": datetime.utcnow().isoformat(),
+            },
             processing_time_ms=round(processing_time, 2)
         )
     
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
-        print(f"❌ Folder suggestion error: {e}")
-        raise HTTPException(status_code=500, detail=f"Folder suggestion failed: {str(e)}")
+        print(f"❌ Batch folder suggestion error: {e}")
+        raise HTTPException(status_code=500, detail=f"Batch folder suggestion failed: {str(e)}")
+
+
+def _build_project_creation_response(result: dict, user_id: Optional[str],
+                                     processing_time: float) -> ProjectCreationResponse:
+    """Chuyển kết quả analyzer thành ProjectCreationResponse"""
+    metadata = result['metadata']
+    metadata.update({
+        "user_id": user_id,
+        "timestamp": datetime.utcnow().isoformat(),
+    })
     
+    return ProjectCreationResponse(
+        success=True,
+        project=ProjectInfo(**result['project']),
+        tasks=[TaskForProject(**task) for task in result['tasks']],
+        metadata=metadata,
+        processing_time_ms=round(processing_time, 2)
+    )
+
+
 @app.post("/api/create-project", response_model=ProjectCreationResponse)
 async def create_project(
     request: ProjectCreationRequest,
-    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer)
+    response: Response,
+    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer),
+    x_latency_budget_ms: Optional[float] = Header(None),
+    deadline: Deadline = Depends(get_deadline),
+    idempotency_key: Optional[str] = Header(None)
 ):
     """
     TẠO PROJECT MỚI với AI
@@ -847,45 +2982,154 @@ async def create_project(
     }
     ```
     """
+    result, replayed = await idempotency_store.run(
+        "create_project", idempotency_key, request,
+        lambda: _create_project(request, analyzer, x_latency_budget_ms, deadline)
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def _create_project(request: ProjectCreationRequest, analyzer: OpenAITaskAnalyzer,
+                          latency_budget_ms: Optional[float], deadline: Deadline) -> ProjectCreationResponse:
     start_time = time.time()
     
     try:
-        result = analyzer.create_project(project_description=request.project_description)
+        result = await asyncio.to_thread(
+            analyzer.create_project,
+            project_description=request.project_description,
+            latency_budget_ms=latency_budget_ms,
+            deadline=deadline
+        )
         
         processing_time = (time.time() - start_time) * 1000
         
-        metadata = result['metadata']
-        metadata.update({
-            "user_id": request.user_id,
-            "timestamp": datetime.utcnow().isoformat(),
-        })
-        
-        return ProjectCreationResponse(
-            success=True,
-            project=ProjectInfo(**result['project']),
-            tasks=[TaskForProject(**task) for task in result['tasks']],
-            metadata=metadata,
-            processing_time_ms=round(processing_time, 2)
-        )
+        return _build_project_creation_response(result, request.user_id, processing_time)
     
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"❌ Project creation error: {e}")
         raise HTTPException(status_code=500, detail=f"Project creation failed: {str(e)}")
 
 
+@app.post("/api/batch-create-project", response_model=BatchProjectCreationResponse)
+async def batch_create_project(
+    request: BatchProjectCreationRequest,
+    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer),
+    x_latency_budget_ms: Optional[float] = Header(None),
+    deadline: Deadline = Depends(get_deadline)
+):
+    """
+    TẠO NHIỀU PROJECTS CÙNG LÚC (ví dụ: template onboarding)
+    
+    - Tạo song song tối đa Config.PROJECT_CONCURRENCY projects
+    - stream = false: trả về đủ kết quả theo đúng thứ tự request
+    - stream = true: NDJSON, mỗi dòng là 1 BatchProjectItemResult ngay khi project đó xong,
+      dòng cuối là {"summary": {...}} (Accept: application/msgpack -> các object msgpack nối tiếp)
+    - Lỗi của từng project không làm hỏng cả batch
+    """
+    if len(request.projects) > Config.MAX_BATCH_PROJECTS:
+        raise HTTPException(status_code=400, detail=f"Maximum {Config.MAX_BATCH_PROJECTS} projects per batch")
+    
+    start_time = time.time()
+    semaphore = asyncio.Semaphore(Config.PROJECT_CONCURRENCY)
+    
+    async def create_one(index: int, item: ProjectCreationRequest) -> BatchProjectItemResult:
+        async with semaphore:
+            item_start = time.time()
+            try:
+                result = await asyncio.to_thread(
+                    analyzer.create_project,
+                    project_description=item.project_description,
+                    latency_budget_ms=x_latency_budget_ms,
+                    deadline=deadline
+                )
+                processing_time = (time.time() - item_start) * 1000
+                return BatchProjectItemResult(
+                    index=index,
+                    success=True,
+                    result=_build_project_creation_response(result, item.user_id, processing_time)
+                )
+            except Exception as e:
+                print(f"❌ Batch project creation error (#{index}): {e}")
+                return BatchProjectItemResult(index=index, success=False, error=str(e))
+    
+    tasks = [asyncio.create_task(create_one(idx, item)) for idx, item in enumerate(request.projects)]
+    
+    if request.stream:
+        fmt = wire_format.get()
+        
+        async def stream_results():
+            successful = 0
+            try:
+                for finished in asyncio.as_completed(tasks):
+                    item_result = await finished
+                    successful += item_result.success
+                    yield encode_stream_item(item_result, fmt)
+            finally:
+                # Client ngắt giữa chừng: dừng luôn các attempt/backoff đang chạy trong thread
+                if not all(task.done() for task in tasks):
+                    deadline.cancel()
+                for task in tasks:
+                    task.cancel()
+            yield encode_stream_item({"summary": {
+                "total": len(tasks),
+                "successful": successful,
+                "failed": len(tasks) - successful,
+                "processing_time_ms": round((time.time() - start_time) * 1000, 2)
+            }}, fmt)
+        
+        return StreamingResponse(stream_results(), media_type=stream_media_type(fmt))
+    
+    try:
+        results = await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        deadline.cancel()
+        raise
+    successful = sum(1 for r in results if r.success)
+    
+    return BatchProjectCreationResponse(
+        total=len(results),
+        successful=successful,
+        failed=len(results) - successful,
+        results=results,
+        processing_time_ms=round((time.time() - start_time) * 1000, 2)
+    )
+
+
 @app.post("/api/batch-analyze")
 async def batch_analyze(
     request: BatchNoteRequest,
-    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer)
+    response: Response,
+    analyzer: OpenAITaskAnalyzer = Depends(get_analyzer),
+    x_latency_budget_ms: Optional[float] = Header(None),
+    deadline: Deadline = Depends(get_deadline),
+    idempotency_key: Optional[str] = Header(None)
 ):
     """Phân tích nhiều notes cùng lúc"""
     if len(request.notes) > Config.MAX_BATCH_SIZE:
         raise HTTPException(status_code=400, detail=f"Maximum {Config.MAX_BATCH_SIZE} notes per batch")
     
+    result, replayed = await idempotency_store.run(
+        "batch_analyze", idempotency_key, request,
+        lambda: _batch_analyze(request, analyzer, x_latency_budget_ms, deadline)
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+async def _batch_analyze(request: BatchNoteRequest, analyzer: OpenAITaskAnalyzer,
+                         latency_budget_ms: Optional[float], deadline: Deadline) -> dict:
     results = []
     for idx, note in enumerate(request.notes):
         try:
-            result = analyzer.analyze(note_text=note.text)
+            result = await asyncio.to_thread(
+                analyzer.analyze, note_text=note.text, latency_budget_ms=latency_budget_ms,
+                deadline=deadline, user_id=note.user_id
+            )
             results.append({
                 "index": idx,
                 "success": True,
@@ -918,6 +3162,13 @@ async def batch_analyze(
 async def get_config():
     return {
         "model": Config.MODEL,
+        "model_tiers": Config.MODEL_TIERS,
+        "endpoint_tiers": Config.ENDPOINT_TIERS,
+        "routing_stats": analyzer.router.snapshot() if analyzer is not None else None,
+        "adaptive_timeouts": analyzer.latency.snapshot() if analyzer is not None else None,
+        "input_compaction": analyzer.compactor.snapshot() if analyzer is not None else None,
+        "semantic_cache": analyzer.semantic_cache.snapshot()
+        if analyzer is not None and analyzer.semantic_cache is not None else None,
         "max_batch_size": Config.MAX_BATCH_SIZE,
         "features": {
             "dynamic_projects": True,
@@ -942,25 +3193,273 @@ async def get_labels():
 # ==================== ERROR HANDLERS ====================
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
-    return {
-        "success": False,
-        "error": exc.detail,
-        "status_code": exc.status_code
-    }
+    return negotiated_response(
+        request,
+        status_code=exc.status_code,
+        content={
+            "success": False,
+            "error": exc.detail,
+            "detail": exc.detail,
+            "status_code": exc.status_code
+        }
+    )
+
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request, exc):
+    return negotiated_response(
+        request,
+        status_code=422,
+        content={"detail": jsonable_encoder(exc.errors())}
+    )
 
 
 @app.exception_handler(Exception)
 async def general_exception_handler(request, exc):
     print(f"❌ Unhandled error: {exc}")
-    return {
-        "success": False,
-        "error": "Internal server error",
-        "detail": str(exc)
-    }
+    return negotiated_response(
+        request,
+        status_code=500,
+        content={
+            "success": False,
+            "error": "Internal server error",
+            "detail": str(exc)
+        }
+    )
+
+
+# ==================== BACKFILL CLI ====================
+class SharedRateLimiter:
+    """Giới hạn số request upstream / giây, dùng chung giữa các process worker"""
+
+    def __init__(self, rate_per_second: float, lock, next_slot):
+        self.interval = 1.0 / rate_per_second
+        self._lock = lock
+        self._next_slot = next_slot  # multiprocessing.Value('d'), epoch seconds
+
+    def acquire(self):
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next_slot.value)
+            self._next_slot.value = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class BackfillCheckpoint:
+    """
+    Trạng thái resume của backfill, kích thước bị chặn bởi số note đang xử lý:
+    - watermark: mọi dòng <= watermark đã xong
+    - done_above: các dòng > watermark đã xong (hoàn thành không theo thứ tự)
+    - output_bytes: kích thước output tương ứng; khi resume output bị cắt về mốc này
+    """
+
+    def __init__(self, watermark: int = -1, done_above: Optional[List[int]] = None,
+                 output_bytes: int = 0, processed: int = 0, failed: int = 0):
+        self.watermark = watermark
+        self.done_above = set(done_above or [])
+        self.output_bytes = output_bytes
+        self.processed = processed
+        self.failed = failed
+
+    @classmethod
+    def load(cls, path: str) -> "BackfillCheckpoint":
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(**json.load(f))
+
+    def save(self, path: str, output_bytes: int):
+        self.output_bytes = output_bytes
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "watermark": self.watermark,
+                "done_above": sorted(self.done_above),
+                "output_bytes": self.output_bytes,
+                "processed": self.processed,
+                "failed": self.failed
+            }, f)
+        os.replace(tmp_path, path)
+
+    def is_done(self, line_no: int) -> bool:
+        return line_no <= self.watermark or line_no in self.done_above
+
+    def mark_done(self, line_no: int, success: bool):
+        self.processed += 1
+        self.failed += 0 if success else 1
+        self.done_above.add(line_no)
+        while self.watermark + 1 in self.done_above:
+            self.watermark += 1
+            self.done_above.remove(self.watermark)
+
+
+def _backfill_worker(in_queue, out_queue, concurrency: int, rate_limit: Optional[float], rate_lock, rate_next):
+    """Process worker: nhận (line_no, note_id, text), chạy analyze với `concurrency` threads"""
+    worker_analyzer = OpenAITaskAnalyzer(api_key=Config.OPENAI_API_KEY, cassette=load_cassette())
+    if rate_limit:
+        worker_analyzer.rate_limiter = SharedRateLimiter(rate_limit, rate_lock, rate_next)
+    
+    slots = threading.Semaphore(concurrency)
+    
+    def process(line_no: int, note_id: Any, text: str):
+        try:
+            result = worker_analyzer.analyze(note_text=text)
+            record = {"line": line_no, "id": note_id, "success": True,
+                      "tasks": result["tasks"], "metadata": result["metadata"]}
+        except Exception as e:
+            record = {"line": line_no, "id": note_id, "success": False, "error": str(e)}
+        finally:
+            slots.release()
+        out_queue.put(record)
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            slots.acquire()
+            pool.submit(process, *item)
+
+
+def _count_lines(path: str) -> int:
+    count = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            count += block.count(b"\n")
+    return count
+
+
+def _read_notes(path: str, text_field: str, id_field: str, checkpoint: BackfillCheckpoint):
+    """
+    Stream (line_no, note_id, text, error) từ JSONL, bỏ qua các dòng đã xong theo checkpoint.
+    Dòng lỗi (JSON hỏng, thiếu text_field) trả về error thay vì làm dừng cả backfill.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if checkpoint.is_done(line_no) or not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+                yield line_no, row.get(id_field, line_no), str(row[text_field]), None
+            except json.JSONDecodeError as e:
+                yield line_no, None, None, f"Invalid JSON: {e}"
+            except (KeyError, TypeError, AttributeError):
+                yield line_no, None, None, f"Missing field \"{text_field}\""
+
+
+def run_backfill(args: argparse.Namespace):
+    """
+    Chạy OpenAITaskAnalyzer trên file JSONL lớn:
+    - args.processes process x args.concurrency threads, rate limit chung args.rate_limit req/s
+    - output ghi dần ra JSONL, checkpoint định kỳ để resume không xử lý lại
+    - số note đang xử lý bị chặn bởi processes x concurrency x 2 -> bộ nhớ không phụ thuộc kích thước input
+    """
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint"
+    checkpoint = BackfillCheckpoint.load(checkpoint_path)
+    total_lines = _count_lines(args.input)
+    
+    # Cắt phần output ghi sau checkpoint cuối (những note đó sẽ được xử lý lại)
+    mode = "r+" if os.path.exists(args.output) else "w"
+    output = open(args.output, mode, encoding="utf-8")
+    output.truncate(checkpoint.output_bytes)
+    output.seek(checkpoint.output_bytes)
+    
+    ctx = multiprocessing.get_context()
+    in_queue = ctx.Queue()
+    out_queue = ctx.Queue()
+    rate_lock = ctx.Lock()
+    rate_next = ctx.Value("d", 0.0)
+    workers = [
+        ctx.Process(
+            target=_backfill_worker,
+            args=(in_queue, out_queue, args.concurrency, args.rate_limit, rate_lock, rate_next),
+            daemon=True
+        )
+        for _ in range(args.processes)
+    ]
+    for worker in workers:
+        worker.start()
+    
+    window = args.processes * args.concurrency * 2
+    notes = _read_notes(args.input, args.text_field, args.id_field, checkpoint)
+    exhausted = False
+    in_flight = 0
+    start_time = time.time()
+    start_processed = checkpoint.processed
+    last_checkpoint = last_report = time.time()
+    
+    print(f"📦 Backfill {args.input} -> {args.output} "
+          f"({args.processes} processes x {args.concurrency} threads, resume from line {checkpoint.watermark + 1})")
+    
+    def write_record(record: dict):
+        nonlocal last_checkpoint, last_report
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        checkpoint.mark_done(record["line"], record["success"])
+        
+        now = time.time()
+        if (checkpoint.processed % args.checkpoint_every == 0
+                or now - last_checkpoint >= Config.BACKFILL_CHECKPOINT_SECONDS):
+            output.flush()
+            checkpoint.save(checkpoint_path, output.tell())
+            last_checkpoint = now
+        
+        if now - last_report >= Config.BACKFILL_REPORT_SECONDS:
+            done_now = checkpoint.processed - start_processed
+            rate = done_now / (now - start_time)
+            remaining = max(0, total_lines - checkpoint.processed)
+            eta = remaining / rate if rate > 0 else float("inf")
+            print(f"⏳ {checkpoint.processed}/{total_lines} notes "
+                  f"({checkpoint.failed} failed) - {rate:.2f} notes/s - ETA {eta / 60:.1f} min")
+            last_report = now
+    
+    try:
+        while True:
+            while not exhausted and in_flight < window:
+                item = next(notes, None)
+                if item is None:
+                    exhausted = True
+                    break
+                line_no, note_id, text, error = item
+                if error is not None:
+                    write_record({"line": line_no, "id": note_id, "success": False, "error": error})
+                    continue
+                in_queue.put((line_no, note_id, text))
+                in_flight += 1
+            
+            if in_flight == 0:
+                break
+            
+            try:
+                record = out_queue.get(timeout=Config.BACKFILL_POLL_SECONDS)
+            except queue.Empty:
+                # Worker chết thì các note nó đang giữ sẽ không bao giờ trả về: dừng,
+                # checkpoint vẫn được lưu ở finally, lần chạy sau xử lý lại các note đó
+                dead = [worker for worker in workers if not worker.is_alive()]
+                if dead:
+                    raise SystemExit(
+                        f"❌ Backfill aborted: {len(dead)}/{len(workers)} worker(s) exited "
+                        f"(exit codes {[worker.exitcode for worker in dead]}). "
+                        f"Checkpoint saved, re-run to resume."
+                    )
+                continue
+            in_flight -= 1
+            write_record(record)
+    finally:
+        for _ in workers:
+            in_queue.put(None)
+        output.flush()
+        checkpoint.save(checkpoint_path, output.tell())
+        output.close()
+        for worker in workers:
+            worker.join(timeout=5)
+    
+    elapsed = time.time() - start_time
+    print(f"✅ Backfill done: {checkpoint.processed} notes ({checkpoint.failed} failed) in {elapsed:.1f}s")
 
 
 # ==================== RUN SERVER ====================
-if __name__ == "__main__":
+def serve():
     print("""
 ╔═══════════════════════════════════════════════════════════╗
 ║   Task Management AI - Project Creation Feature          ║
@@ -968,10 +3467,41 @@ if __name__ == "__main__":
 ╚═══════════════════════════════════════════════════════════╝
     """)
     
+    import uvicorn
+    
     uvicorn.run(
         "backend_api:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
+        reload=Config.SERVER_RELOAD,
         log_level="info"
-    )
\ No newline at end of file
+    )
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Task Management AI backend")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("serve", help="Chạy API server (mặc định)")
+    
+    backfill = subparsers.add_parser("backfill", help="Phân tích offline 1 file JSONL notes")
+    backfill.add_argument("--input", required=True, help="JSONL input, mỗi dòng 1 note")
+    backfill.add_argument("--output", required=True, help="JSONL output, ghi dần theo thứ tự hoàn thành")
+    backfill.add_argument("--checkpoint", help="File checkpoint (mặc định: <output>.checkpoint)")
+    backfill.add_argument("--text-field", default="text")
+    backfill.add_argument("--id-field", default="id")
+    backfill.add_argument("--processes", type=int, default=2)
+    backfill.add_argument("--concurrency", type=int, default=4, help="Số request song song / process")
+    backfill.add_argument("--rate-limit", type=float, default=None, help="Request upstream / giây (toàn bộ)")
+    backfill.add_argument("--checkpoint-every", type=int, default=100, help="Checkpoint sau mỗi N notes")
+    
+    args = parser.parse_args(argv)
+    if args.command == "backfill":
+        run_backfill(args)
+    else:
+        serve()
+
+
+startup_state.timings["import_ms"] = round((time.perf_counter() - _IMPORT_STARTED) * 1000, 1)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,139 @@
+"""
+Benchmark: schema JSON dài (cũ) vs schema gọn + strict structured outputs (mới)
+Chạy offline (đếm bytes/tokens của output mẫu):
+    python benchmarks/bench_compact_schema.py
+Chạy live với OpenAI (đo completion tokens + latency thật, cần OPENAI_API_KEY):
+    python benchmarks/bench_compact_schema.py --live --rounds 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from backend_api import (  # noqa: E402
+    ANALYSIS_RESPONSE_FORMAT,
+    Config,
+    OpenAITaskAnalyzer,
+    estimate_tokens,
+)
+
+SAMPLE_NOTES = [
+    "Tuần này cần hoàn thành báo cáo Q4 trước thứ 6, gửi email cho 50 khách hàng về sản phẩm mới",
+    "Chuẩn bị slide cho buổi họp team sáng thứ 2, review pull request của Nam và cập nhật tài liệu API",
+    "Học Python cơ bản về vòng lặp và hàm, làm bài tập chương 3, đăng ký khóa học nâng cao",
+]
+
+# Định dạng output cũ (trước khi chuyển sang schema gọn) - giữ lại để so sánh
+LEGACY_ANALYZE_FORMAT = """
+Xuất ra JSON theo đúng định dạng sau (KHÔNG thêm markdown):
+{
+  "success": true,
+  "tasks": [
+    {
+      "task_id": "uuid-string",
+      "task_text": "Câu tiếng Việt hoàn chỉnh mô tả công việc cụ thể cần làm",
+      "estimated_time_minutes": 45,
+      "priority": "Medium",
+      "suggested_project": "Tên dự án bạn tự đề xuất - ngắn gọn, có ý nghĩa",
+      "suggested_topic": "Tên chủ đề bạn tự đề xuất - mô tả loại công việc"
+    }
+  ]
+}"""
+
+
+def _token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(Config.MODEL)
+        return "tiktoken", lambda text: len(encoding.encode(text))
+    except Exception:
+        return "estimate", estimate_tokens
+
+
+def _sample_tasks(n: int):
+    return [
+        {
+            "task_text": f"Thu thập số liệu doanh thu quý bốn cho phần {i} của báo cáo",
+            "estimated_time_minutes": 45,
+            "priority": "High",
+            "suggested_project": "Báo Cáo Quý 4",
+            "suggested_topic": "Viết Báo Cáo",
+        }
+        for i in range(1, n + 1)
+    ]
+
+
+def offline_benchmark():
+    counter_name, count = _token_counter()
+    print(f"Token counter: {counter_name}")
+    print(f"{'tasks':>6} {'legacy bytes':>13} {'compact bytes':>14} {'legacy tok':>11} {'compact tok':>12} {'saved':>7}")
+
+    for n in (3, 8, 15):
+        tasks = _sample_tasks(n)
+        legacy = json.dumps(
+            {"success": True, "tasks": [{"task_id": str(uuid.uuid4()), **t} for t in tasks]},
+            ensure_ascii=False, indent=2
+        )
+        compact = json.dumps(
+            {"t": [
+                {"x": t["task_text"], "m": t["estimated_time_minutes"], "p": t["priority"][0],
+                 "j": t["suggested_project"], "c": t["suggested_topic"]}
+                for t in tasks
+            ]},
+            ensure_ascii=False, separators=(",", ":")
+        )
+        legacy_tokens, compact_tokens = count(legacy), count(compact)
+        saved = 1 - compact_tokens / legacy_tokens
+        print(f"{n:>6} {len(legacy.encode()):>13} {len(compact.encode()):>14} "
+              f"{legacy_tokens:>11} {compact_tokens:>12} {saved:>6.0%}")
+
+
+def _timed_call(analyzer: OpenAITaskAnalyzer, user_prompt: str, response_format: dict):
+    start = time.time()
+    response = analyzer.client.chat.completions.create(
+        model=analyzer.model,
+        temperature=analyzer.temperature,
+        messages=[
+            {"role": "system", "content": analyzer._construct_system_prompt()},
+            {"role": "user", "content": user_prompt},
+        ],
+        response_format=response_format,
+        timeout=Config.TIMEOUT,
+    )
+    return (time.time() - start) * 1000, response.usage.completion_tokens
+
+
+def live_benchmark(rounds: int):
+    analyzer = OpenAITaskAnalyzer(api_key=Config.OPENAI_API_KEY)
+    results = {"legacy": [], "compact": []}
+
+    for _ in range(rounds):
+        for note in SAMPLE_NOTES:
+            compact_prompt = analyzer._construct_user_prompt(note)
+            legacy_prompt = compact_prompt[:compact_prompt.index("Xuất JSON dạng gọn")] + LEGACY_ANALYZE_FORMAT
+            results["legacy"].append(_timed_call(analyzer, legacy_prompt, {"type": "json_object"}))
+            results["compact"].append(_timed_call(analyzer, compact_prompt, ANALYSIS_RESPONSE_FORMAT))
+
+    print(f"Model: {analyzer.model}, {rounds} rounds x {len(SAMPLE_NOTES)} notes")
+    print(f"{'schema':>8} {'p50 latency ms':>15} {'p50 completion tok':>19}")
+    for name, samples in results.items():
+        latencies = [latency for latency, _ in samples]
+        tokens = [tok for _, tok in samples]
+        print(f"{name:>8} {statistics.median(latencies):>15.0f} {statistics.median(tokens):>19.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", action="store_true", help="Gọi OpenAI thật để đo latency")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    offline_benchmark()
+    if args.live:
+        live_benchmark(args.rounds)
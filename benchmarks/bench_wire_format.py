@@ -0,0 +1,102 @@
+"""
+Benchmark: JSON vs MessagePack cho response batch 50 notes (shape của /api/batch-analyze)
+Đo thời gian encode/decode và số bytes trên đường truyền (cần: pip install msgpack):
+    python benchmarks/bench_wire_format.py
+    python benchmarks/bench_wire_format.py --notes 50 --tasks 5 --rounds 200
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import msgpack  # noqa: E402
+
+from backend_api import BatchNoteRequest  # noqa: E402
+
+SAMPLE_NOTE = (
+    "Tuần này cần hoàn thành báo cáo Q4 trước thứ 6, gửi email cho 50 khách hàng về sản phẩm mới, "
+    "chuẩn bị slide cho buổi họp team sáng thứ 2 và review pull request của Nam"
+)
+
+
+def _batch_request(notes: int) -> dict:
+    payload = {"notes": [{"text": f"{SAMPLE_NOTE} ({i})", "user_id": "user_123"} for i in range(notes)]}
+    BatchNoteRequest(**payload)  # đảm bảo đúng schema của endpoint
+    return payload
+
+
+def _batch_response(notes: int, tasks: int) -> dict:
+    results = []
+    for idx in range(notes):
+        note_text = f"{SAMPLE_NOTE} ({idx})"
+        results.append({
+            "index": idx,
+            "success": True,
+            "note_text": note_text[:100] + "..." if len(note_text) > 100 else note_text,
+            "tasks_count": tasks,
+            "projects_discovered": ["Báo Cáo Quý 4", "Marketing"],
+            "topics_discovered": ["Viết Báo Cáo", "Email"],
+            "tasks": [
+                {
+                    "task_id": str(uuid.uuid4()),
+                    "task_text": f"Thu thập số liệu doanh thu quý bốn cho phần {t} của báo cáo",
+                    "estimated_time_minutes": 45,
+                    "priority": "High",
+                    "suggested_project": "Báo Cáo Quý 4",
+                    "suggested_topic": "Viết Báo Cáo",
+                    "created_at": datetime.utcnow().isoformat()
+                }
+                for t in range(tasks)
+            ]
+        })
+    return {"total": notes, "successful": notes, "failed": 0, "results": results}
+
+
+def _time_ms(fn, rounds: int) -> float:
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def _compare(label: str, payload: dict, rounds: int):
+    json_bytes = json.dumps(payload, ensure_ascii=False).encode()
+    msgpack_bytes = msgpack.packb(payload)
+    rows = {
+        "json": (
+            len(json_bytes),
+            _time_ms(lambda: json.dumps(payload, ensure_ascii=False).encode(), rounds),
+            _time_ms(lambda: json.loads(json_bytes), rounds),
+        ),
+        "msgpack": (
+            len(msgpack_bytes),
+            _time_ms(lambda: msgpack.packb(payload), rounds),
+            _time_ms(lambda: msgpack.unpackb(msgpack_bytes), rounds),
+        ),
+    }
+    print(f"\n{label}")
+    print(f"{'format':>8} {'bytes':>9} {'encode ms':>10} {'decode ms':>10}")
+    for name, (size, encode_ms, decode_ms) in rows.items():
+        print(f"{name:>8} {size:>9} {encode_ms:>10.3f} {decode_ms:>10.3f}")
+    print(f"{'saved':>8} {1 - rows['msgpack'][0] / rows['json'][0]:>9.0%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--notes", type=int, default=50)
+    parser.add_argument("--tasks", type=int, default=5, help="Số tasks / note trong response")
+    parser.add_argument("--rounds", type=int, default=100)
+    args = parser.parse_args()
+
+    _compare(f"Request /api/batch-analyze ({args.notes} notes)", _batch_request(args.notes), args.rounds)
+    _compare(f"Response /api/batch-analyze ({args.notes} notes x {args.tasks} tasks)",
+             _batch_response(args.notes, args.tasks), args.rounds)
@@ -13,6 +13,8 @@ class AIService {
     this.AI_BACKEND_URL = process.env.AI_BACKEND_URL || 'http://localhost:8000';
     this.ANALYZE_ENDPOINT = `${this.AI_BACKEND_URL}/api/analyze`;
     this.CREATE_PROJECT_ENDPOINT = `${this.AI_BACKEND_URL}/api/create-project`;
+    this.ANALYZE_AND_PLACE_ENDPOINT = `${this.AI_BACKEND_URL}/api/analyze-and-place`;
+    this.TAXONOMY_ENDPOINT = `${this.AI_BACKEND_URL}/api/taxonomy`;
     this.TIMEOUT = 30000;
   }
 
@@ -30,7 +32,8 @@ class AIService {
         {
           timeout: this.TIMEOUT,
           headers: {
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            'X-Request-Deadline-Ms': String(this.TIMEOUT)
           }
         }
       );
@@ -55,6 +58,98 @@ class AIService {
     }
   }
 
+  /**
+   * Gọi AI backend để phân tích nội dung VÀ xếp vào area/folder của user (1 request)
+   * Gửi kèm taxonomy_version: nếu AI backend chưa có taxonomy của user hoặc đang giữ
+   * bản cũ (409) thì gửi kèm areas/folders và gọi lại
+   */
+  async callAnalyzeAndPlace(text, userId) {
+    const taxonomyVersion = await this._taxonomyVersion(userId);
+    const post = (taxonomy) => axios.post(
+      this.ANALYZE_AND_PLACE_ENDPOINT,
+      {
+        text: text,
+        user_id: userId.toString(),
+        taxonomy_version: taxonomyVersion,
+        taxonomy
+      },
+      {
+        timeout: this.TIMEOUT,
+        headers: {
+          'Content-Type': 'application/json',
+          'X-Request-Deadline-Ms': String(this.TIMEOUT)
+        }
+      }
+    );
+
+    try {
+      let response;
+      try {
+        response = await post(undefined);
+      } catch (error) {
+        if (error.response?.status !== 409) throw error;
+        response = await post({ ...(await this._loadTaxonomy(userId)), version: taxonomyVersion });
+      }
+
+      if (!response.data || !response.data.success) {
+        throw new Error('AI backend returned unsuccessful response');
+      }
+
+      return response.data;
+    } catch (error) {
+      console.error('AI Analyze-and-place Error:', error.message);
+      
+      if (error.code === 'ECONNREFUSED') {
+        throw new Error('AI service is unavailable. Please ensure the AI backend is running.');
+      }
+      
+      if (error.response?.data?.detail) {
+        throw new Error(`AI Error: ${error.response.data.detail}`);
+      }
+      
+      throw new Error(`Failed to analyze content: ${error.message}`);
+    }
+  }
+
+  /**
+   * Areas + folders của user theo format taxonomy của AI backend
+   */
+  async _loadTaxonomy(userId) {
+    const [userAreas, userFolders] = await Promise.all([
+      Area.find({ userId }).select('_id name').lean(),
+      Folder.find({ userId }).select('_id name areaId').lean()
+    ]);
+
+    return {
+      areas: userAreas.map(a => ({ _id: a._id.toString(), name: a.name })),
+      folders: userFolders.map(f => ({ _id: f._id.toString(), name: f.name, areaId: f.areaId.toString() }))
+    };
+  }
+
+  /**
+   * Version taxonomy của user: số lượng + updatedAt mới nhất của areas và folders
+   * (đổi khi thêm/sửa/xóa area hoặc folder, không cần load toàn bộ)
+   */
+  async _taxonomyVersion(userId) {
+    const [areaCount, lastArea, folderCount, lastFolder] = await Promise.all([
+      Area.countDocuments({ userId }),
+      Area.findOne({ userId }).sort({ updatedAt: -1 }).select('updatedAt').lean(),
+      Folder.countDocuments({ userId }),
+      Folder.findOne({ userId }).sort({ updatedAt: -1 }).select('updatedAt').lean()
+    ]);
+
+    const stamp = (doc) => (doc?.updatedAt ? new Date(doc.updatedAt).getTime() : 0);
+    return `${areaCount}.${stamp(lastArea)}-${folderCount}.${stamp(lastFolder)}`;
+  }
+
+  /**
+   * Báo AI backend bỏ taxonomy đã cache (gọi sau khi area/folder thay đổi)
+   */
+  invalidateTaxonomy(userId) {
+    axios.delete(`${this.TAXONOMY_ENDPOINT}/${userId.toString()}`, { timeout: 5000 })
+      .catch(error => console.error('AI Taxonomy invalidate error:', error.message));
+  }
+
   /**
    * Gọi AI backend để tạo project với tasks
    */
@@ -69,7 +164,8 @@ class AIService {
         {
           timeout: this.TIMEOUT,
           headers: {
-            'Content-Type': 'application/json'
+            'Content-Type': 'application/json',
+            'X-Request-Deadline-Ms': String(this.TIMEOUT)
           }
         }
       );
@@ -307,8 +403,8 @@ class AIService {
    */
   async createQuickNote(userId, text) {
     try {
-      // 1. Gọi AI để phân tích text
-      const aiResponse = await this.callAIBackend(text, userId);
+      // 1. Gọi AI để phân tích text và xếp vào area/folder
+      const aiResponse = await this.callAnalyzeAndPlace(text, userId);
       const tasks = aiResponse.tasks || [];
       const metadata = aiResponse.metadata || {};
 
@@ -361,18 +457,17 @@ class AIService {
         content = `${text}\n\n--- Tasks detected by AI ---\n${taskList}`;
       }
 
-      // 5. Lấy tất cả areas và folders hiện có
-      const [userAreas, userFolders] = await Promise.all([
-        Area.find({ userId }).lean(),
-        Folder.find({ userId }).lean()
-      ]);
+      // 5. Area/folder đã được AI backend resolve
+      const placement = { area: aiResponse.area, folder: aiResponse.folder };
 
-      // 6. Tìm HOẶC TẠO area phù hợp
-      let targetArea = this._findBestMatchingArea(aiProjects, aiTopics, userAreas);
+      // 6. Lấy HOẶC TẠO area phù hợp
+      let targetArea = placement.area.is_new
+        ? null
+        : await Area.findOne({ _id: placement.area.id, userId }).lean();
       let areaCreated = false;
 
       if (!targetArea) {
-        const areaName = aiProjects[0] || aiTopics[0] || 'General';
+        const areaName = placement.area.name;
         const newArea = new Area({
           userId,
           name: areaName,
@@ -385,12 +480,14 @@ class AIService {
         areaCreated = true;
       }
 
-      // 7. Tìm HOẶC TẠO folder phù hợp
-      let targetFolder = this._findBestMatchingFolder(aiProjects, aiTopics, userFolders, targetArea._id);
+      // 7. Lấy HOẶC TẠO folder phù hợp
+      let targetFolder = placement.folder.is_new || areaCreated
+        ? null
+        : await Folder.findOne({ _id: placement.folder.id, userId, areaId: targetArea._id }).lean();
       let folderCreated = false;
 
       if (!targetFolder) {
-        const folderName = aiTopics[0] || aiProjects[0] || 'Notes';
+        const folderName = placement.folder.name;
         const newFolder = new Folder({
           userId,
           areaId: targetArea._id,
@@ -404,6 +501,10 @@ class AIService {
         folderCreated = true;
       }
 
+      if (areaCreated || folderCreated) {
+        this.invalidateTaxonomy(userId);
+      }
+
       // 8. Tạo tags từ topics
       const tags = [...new Set(aiTopics)].slice(0, 5);
 
@@ -479,6 +580,7 @@ class AIService {
         icon: 0
       });
       await area.save();
+      this.invalidateTaxonomy(userId);
     }
 
     return area.toObject();
@@ -500,6 +602,7 @@ class AIService {
         icon: 0
       });
       await folder.save();
+      this.invalidateTaxonomy(userId);
     }
 
     return folder.toObject();
@@ -592,6 +695,10 @@ class AIService {
         folderCreated = true;
       }
 
+      if (areaCreated || folderCreated) {
+        this.invalidateTaxonomy(userId);
+      }
+
       // 7. Tạo tags từ topics
       const suggestedTags = [...new Set([...card.tags, ...aiTopics])].slice(0, 5);
 
@@ -1038,7 +1145,8 @@ async suggestFolder(userId, noteText) {
       {
         timeout: 30000,
         headers: {
-          'Content-Type': 'application/json'
+          'Content-Type': 'application/json',
+          'X-Request-Deadline-Ms': '30000'
         }
       }
     );
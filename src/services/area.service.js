@@ -1,4 +1,5 @@
 const Area = require('../models/Area');
+const aiService = require('./ai.service');
 const Folder = require('../models/Folder');
 const Card = require('../models/Card');
 const Project = require('../models/Project');
@@ -89,6 +90,7 @@ class AreaService {
     
     const area = new Area({ userId, ...data });
     await area.save();
+    aiService.invalidateTaxonomy(userId);
     return area;
   }
 
@@ -103,6 +105,7 @@ class AreaService {
       throw new Error('Area not found');
     }
 
+    aiService.invalidateTaxonomy(userId);
     return area;
   }
 
@@ -111,6 +114,7 @@ class AreaService {
     if (!area) {
       throw new Error('Area not found');
     }
+    aiService.invalidateTaxonomy(userId);
     return area;
   }
 }
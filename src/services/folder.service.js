@@ -1,4 +1,5 @@
 const Folder = require('../models/Folder');
+const aiService = require('./ai.service');
 const Card = require('../models/Card');
 
 class FolderService {
@@ -46,6 +47,7 @@ class FolderService {
     }
     
     await folder.save();
+    aiService.invalidateTaxonomy(userId);
     return folder;
   }
 
@@ -64,6 +66,7 @@ class FolderService {
     }
 
     await folder.save();
+    aiService.invalidateTaxonomy(userId);
     return folder;
   }
 
@@ -72,6 +75,7 @@ class FolderService {
     if (!folder) {
       throw new Error('Folder not found');
     }
+    aiService.invalidateTaxonomy(userId);
     return folder;
   }
 